@@ -0,0 +1,74 @@
+import numpy as np
+
+# sRGB <-> linear color conversion shared by the grease pencil add-ons.
+# Brush colors are sRGB while stroke vertex colors are stored linear.
+
+def s2lin(x): # convert srgb to linear
+    a = 0.055
+    if x <= 0.04045:
+        y = x * (1.0 /12.92)
+    else:
+        y = pow ( (x + a) * (1.0 / (1 + a)), 2.4)
+    return y
+
+def lin2s(y): # convert linear to srgb
+    a = 0.055
+    if y <= 0.0031308:
+        x = y * 12.92
+    else:
+        x = (1 + a) * pow(y, 1.0 / 2.4) - a
+    return x
+
+def srgb_to_linear(colors):
+    """Convert an array of sRGB values to linear, element-wise."""
+    x = np.asarray(colors, dtype=np.float64)
+    return np.where(x <= 0.04045, x * (1.0 / 12.92),
+        np.power((np.maximum(x, 0.04045) + 0.055) * (1.0 / 1.055), 2.4))
+
+def linear_to_srgb(colors):
+    """Convert an array of linear values to sRGB, element-wise."""
+    y = np.asarray(colors, dtype=np.float64)
+    return np.where(y <= 0.0031308, y * 12.92,
+        1.055 * np.power(np.maximum(y, 0.0031308), 1.0 / 2.4) - 0.055)
+
+def srgb_to_linear_rgba(color, alpha = 1):
+    """Return an sRGB color (anything with 3 or more channels) as a linear RGBA tuple."""
+    return (s2lin(color[0]), s2lin(color[1]), s2lin(color[2]), alpha)
+
+_lut8 = None
+_lut16 = None
+
+def srgb8_to_linear(values):
+    """Convert 8-bit sRGB integers (0-255) to linear floats through a lookup table."""
+    global _lut8
+    if _lut8 is None:
+        _lut8 = srgb_to_linear(np.arange(256) / 255.0).astype(np.float32)
+    return _lut8[np.asarray(values, dtype=np.uint8)]
+
+def srgb16_to_linear(values):
+    """Convert 16-bit sRGB integers (0-65535) to linear floats through a lookup table."""
+    global _lut16
+    if _lut16 is None:
+        _lut16 = srgb_to_linear(np.arange(65536) / 65535.0).astype(np.float32)
+    return _lut16[np.asarray(values, dtype=np.uint16)]
+
+if __name__ == "__main__":
+    # check the array versions and lookup tables against the scalar formulas
+    xs = np.concatenate((np.linspace(0, 1, 10001), np.nextafter(0.04045, [0, 1]), np.nextafter(0.0031308, [0, 1]), [0.04045, 0.0031308]))
+
+    lin = srgb_to_linear(xs)
+    assert np.allclose(lin, [s2lin(x) for x in xs], rtol = 1e-12, atol = 0)
+    srgb = linear_to_srgb(xs)
+    assert np.allclose(srgb, [lin2s(x) for x in xs], rtol = 1e-12, atol = 0)
+    assert np.allclose(linear_to_srgb(srgb_to_linear(xs)), xs, atol = 1e-12)
+    assert np.allclose(srgb_to_linear(linear_to_srgb(xs)), xs, atol = 1e-12)
+
+    v8 = np.arange(256)
+    assert np.allclose(srgb8_to_linear(v8), srgb_to_linear(v8 / 255.0), atol = 1e-7)
+    assert np.array_equal(np.round(linear_to_srgb(srgb8_to_linear(v8)) * 255), v8)
+    v16 = np.arange(65536)
+    assert np.allclose(srgb16_to_linear(v16), srgb_to_linear(v16 / 65535.0), atol = 1e-7)
+    assert np.array_equal(np.round(linear_to_srgb(srgb16_to_linear(v16)) * 65535), v16)
+
+    assert np.allclose(srgb_to_linear_rgba((0.5, 0.04045, 1.0, 0.3), 0.5), [s2lin(0.5), s2lin(0.04045), 1.0, 0.5])
+    print("gp_Color matches the scalar formulas")
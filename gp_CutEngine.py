@@ -0,0 +1,429 @@
+import numpy as np
+
+# Stroke cutting for gp_CutStroke, kept free of bpy so it can be tested and
+# timed outside of Blender. Strokes are 2D polylines on the XZ drawing plane.
+
+def cross2d(p, q):
+    return p[..., 0] * q[..., 1] - p[..., 1] * q[..., 0]
+
+def segment_intersections(p1, p2, a, b):
+    """Crossings of segment p1-p2 with the segments a-b, given as (M,2) arrays.
+Returns (hit, t) where t is the position of the crossing along each a-b.
+A crossing exactly at b is left to the segment starting there."""
+    p1 = np.asarray(p1, dtype=np.float64)
+    r = np.asarray(p2, dtype=np.float64) - p1
+    d = b - a
+    denom = cross2d(r, d)
+    ok = np.abs(denom) > 1e-12
+    denom = np.where(ok, denom, 1)
+    ap = a - p1
+    s = cross2d(ap, d) / denom
+    t = cross2d(ap, r) / denom
+    hit = ok & (s >= 0) & (s <= 1) & (t >= 0) & (t < 1)
+    return hit, t
+
+class CutFrame:
+    """The strokes of one frame with their cached bounding boxes."""
+
+    def __init__(self, strokes = (), cyclic = None):
+        self.strokes = [np.asarray(s, dtype=np.float64).reshape(-1, 2) for s in strokes]
+        if cyclic is None:
+            cyclic = np.zeros(len(self.strokes), dtype=bool)
+        self.cyclic = np.asarray(cyclic, dtype=bool)
+        self.lo, self.hi = stroke_bounds(self.strokes)
+
+    def __len__(self):
+        return len(self.strokes)
+
+    def replace(self, i, stroke):
+        """Replace stroke i, updating its bounding box."""
+        self.strokes[i] = np.asarray(stroke, dtype=np.float64).reshape(-1, 2)
+        lo, hi = stroke_bounds([self.strokes[i]])
+        self.lo[i] = lo[0]
+        self.hi[i] = hi[0]
+
+    def append(self, stroke, cyclic = False):
+        self.strokes.append(np.asarray(stroke, dtype=np.float64).reshape(-1, 2))
+        lo, hi = stroke_bounds(self.strokes[-1:])
+        self.lo = np.concatenate((self.lo, lo))
+        self.hi = np.concatenate((self.hi, hi))
+        self.cyclic = np.append(self.cyclic, cyclic)
+
+    def remove(self, i):
+        del self.strokes[i]
+        self.lo = np.delete(self.lo, i, axis=0)
+        self.hi = np.delete(self.hi, i, axis=0)
+        self.cyclic = np.delete(self.cyclic, i)
+
+    def candidates(self, lo, hi):
+        """Indices of the strokes whose bounding boxes overlap the box lo, hi."""
+        return np.flatnonzero(np.all((self.lo <= hi) & (self.hi >= lo), axis=1))
+
+    def segments(self, ids):
+        """Start and end points of the segments of strokes ids, with the stroke
+and start point index of each segment. Cyclic strokes include their closing segment."""
+        a = []
+        b = []
+        stroke = []
+        index = []
+        for i in ids:
+            co = self.strokes[i]
+            n = len(co)
+            if n < 2:
+                continue
+            if self.cyclic[i] and n > 2:
+                a.append(co)
+                b.append(np.roll(co, -1, axis=0))
+                m = n
+            else:
+                a.append(co[:-1])
+                b.append(co[1:])
+                m = n - 1
+            stroke.append(np.full(m, i))
+            index.append(np.arange(m))
+        if not a:
+            empty = np.zeros((0, 2))
+            return empty, empty, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(a), np.concatenate(b), np.concatenate(stroke), np.concatenate(index)
+
+    def cut_path(self, path):
+        """Where a polyline of (K,2) points crosses the strokes, returned like cut().
+The knife's segments are bucketed in a SegmentGrid and only stroke segments
+sharing a cell with one are tested."""
+        path = np.asarray(path, dtype=np.float64).reshape(-1, 2)
+        if len(path) < 2:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, np.zeros(0), np.zeros((0, 2))
+        if len(path) == 2:
+            return self.cut(path[0], path[1])
+
+        ids = self.candidates(path.min(axis=0), path.max(axis=0))
+        a, b, stroke, index = self.segments(ids)
+        knife = SegmentGrid(path[:-1], path[1:])
+        k, i, s, t = knife.crossings(a, b)
+        # a crossing at a knife vertex belongs to the knife segment starting there,
+        # one at a stroke point to the stroke segment starting there
+        keep = ((s < 1) | (k == len(path) - 2)) & (t < 1)
+        i, t = i[keep], t[keep]
+        a, b, stroke, index = a[i], b[i], stroke[i], index[i]
+        order = np.lexsort((t, index, stroke))
+        a, b, stroke, index, t = a[order], b[order], stroke[order], index[order], t[order]
+        return stroke, index, t, a + (b - a) * t[:, None]
+
+    def cut(self, p1, p2):
+        """Where the segment p1-p2 crosses the strokes.
+Returns (stroke, segment, t, points): stroke index, index of the segment's first
+point, position along the segment and the crossing, ordered along each stroke."""
+        p1 = np.asarray(p1, dtype=np.float64)
+        p2 = np.asarray(p2, dtype=np.float64)
+        ids = self.candidates(np.minimum(p1, p2), np.maximum(p1, p2))
+
+        # drop strokes whose boxes lie entirely on one side of the line
+        if len(ids):
+            lo = self.lo[ids]
+            hi = self.hi[ids]
+            corners = np.stack((lo, np.stack((lo[:, 0], hi[:, 1]), axis=1), hi,
+                                np.stack((hi[:, 0], lo[:, 1]), axis=1)), axis=1)
+            side = cross2d(p2 - p1, corners - p1)
+            ids = ids[(side.min(axis=1) <= 0) & (side.max(axis=1) >= 0)]
+
+        a, b, stroke, index = self.segments(ids)
+        hit, t = segment_intersections(p1, p2, a, b)
+        a, b, stroke, index, t = a[hit], b[hit], stroke[hit], index[hit], t[hit]
+        order = np.lexsort((t, index, stroke))
+        a, b, stroke, index, t = a[order], b[order], stroke[order], index[order], t[order]
+        return stroke, index, t, a + (b - a) * t[:, None]
+
+class SegmentGrid:
+    """2D segments bucketed into a uniform grid, each filed under every cell its
+bounding box touches, for finding crossings without testing all pairs. Segments
+whose boxes span LONG cells or more are kept apart and tested directly."""
+
+    LONG = 4
+
+    def __init__(self, a, b, cell = None):
+        self.a = np.asarray(a, dtype=np.float64).reshape(-1, 2)
+        self.b = np.asarray(b, dtype=np.float64).reshape(-1, 2)
+        self.lo = np.minimum(self.a, self.b)
+        self.hi = np.maximum(self.a, self.b)
+        lo, hi = self.lo, self.hi
+        if len(lo) == 0:
+            lo = hi = np.zeros((1, 2))
+        self.origin = lo.min(axis=0)
+        extent = hi.max(axis=0) - self.origin
+        if cell is None:
+            # about two segments across a cell, without letting the grid grow past 4096 cells a side
+            cell = 2 * np.mean(np.max(hi - lo, axis=1))
+        self.cell = max(cell, extent.max() / 4096, 1e-9)
+        self.cols, self.rows = (extent // self.cell).astype(np.int64) + 1
+
+        keys, ids, self.long = self._file(self.a, self.b)
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.ids = ids[order]
+        short = np.ones(len(self.a), dtype=bool)
+        short[self.long] = False
+        self.short = np.flatnonzero(short)
+
+    def __len__(self):
+        return len(self.a)
+
+    def _file(self, a, b):
+        # (cell key, segment) for every cell each segment's box touches inside the grid,
+        # and the segments whose boxes span too many cells to file
+        lo = np.floor((np.minimum(a, b) - self.origin) / self.cell).astype(np.int64)
+        hi = np.floor((np.maximum(a, b) - self.origin) / self.cell).astype(np.int64)
+        inside = np.all((hi >= 0) & (lo < (self.cols, self.rows)), axis=1)
+        lo = np.maximum(lo, 0)
+        hi = np.minimum(hi, (self.cols - 1, self.rows - 1))
+        nx = np.where(inside, hi[:, 0] - lo[:, 0] + 1, 0)
+        ny = np.where(inside, hi[:, 1] - lo[:, 1] + 1, 0)
+        long = np.maximum(nx, ny) > self.LONG
+        nx[long] = 0
+        n = nx * ny
+        ids = np.repeat(np.arange(len(a)), n)
+        k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        nx = np.repeat(nx, n)
+        cx = np.repeat(lo[:, 0], n) + k % np.maximum(nx, 1)
+        cy = np.repeat(lo[:, 1], n) + k // np.maximum(nx, 1)
+        return cy * self.cols + cx, ids, np.flatnonzero(long)
+
+    def _gather(self, keys, ids):
+        # (grid segment, query) pairs sharing a cell, each pair once
+        first = np.searchsorted(self.keys, keys, 'left')
+        n = np.searchsorted(self.keys, keys, 'right') - first
+        query = np.repeat(ids, n)
+        k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        grid = self.ids[np.repeat(first, n) + k]
+        m = query.max(initial=0) + 1
+        pairs = np.unique(grid * m + query)
+        return pairs // m, pairs % m
+
+    def _overlaps(self, i, j, c, d):
+        # (grid segment, query) pairs of grid segments i and queries j whose boxes overlap
+        lo = np.minimum(c[j], d[j])
+        hi = np.maximum(c[j], d[j])
+        hit = np.all((self.lo[i, None] <= hi[None]) & (self.hi[i, None] >= lo[None]), axis=2)
+        gi, qj = np.nonzero(hit)
+        return i[gi], j[qj]
+
+    def candidates(self, c, d):
+        """(grid segment, query segment) pairs whose cells meet, for query segments c-d."""
+        c = np.asarray(c, dtype=np.float64).reshape(-1, 2)
+        d = np.asarray(d, dtype=np.float64).reshape(-1, 2)
+        keys, ids, long = self._file(c, d)
+        i, j = self._gather(keys, ids)
+        # long segments on either side against everything their boxes overlap
+        li, lj = self._overlaps(self.long, np.arange(len(c)), c, d)
+        si, sj = self._overlaps(self.short, long, c, d)
+        return np.concatenate((i, li, si)), np.concatenate((j, lj, sj))
+
+    def line_cells(self, p1, p2):
+        """Keys of the grid cells the segment p1-p2 passes through."""
+        p1 = (np.asarray(p1, dtype=np.float64) - self.origin) / self.cell
+        d = (np.asarray(p2, dtype=np.float64) - self.origin) / self.cell - p1
+        # positions along the segment where it crosses grid lines inside the grid
+        ts = [np.array([0.0, 1.0])]
+        for axis, count in ((0, self.cols), (1, self.rows)):
+            if d[axis] != 0:
+                lo, hi = sorted((p1[axis], p1[axis] + d[axis]))
+                lines = np.arange(max(np.ceil(lo), 0), min(np.floor(hi), count) + 1)
+                ts.append((lines - p1[axis]) / d[axis])
+        t = np.unique(np.clip(np.concatenate(ts), 0, 1))
+        mid = (t[:-1] + t[1:]) / 2 if len(t) > 1 else t
+        cells = np.floor(p1 + d * mid[:, None]).astype(np.int64)
+        cells = cells[np.all((cells >= 0) & (cells < (self.cols, self.rows)), axis=1)]
+        return np.unique(cells[:, 1] * self.cols + cells[:, 0])
+
+    def line_crossings(self, p1, p2):
+        """Crossings of the segment p1-p2 with the grid's segments, looking only in
+the cells it passes through. Returns (segment, s along it, points)."""
+        keys = self.line_cells(p1, p2)
+        first = np.searchsorted(self.keys, keys, 'left')
+        n = np.searchsorted(self.keys, keys, 'right') - first
+        k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        ids = np.union1d(self.ids[np.repeat(first, n) + k], self.long)
+        a = self.a[ids]
+        hit, s = segment_intersections(p1, p2, a, self.b[ids])
+        ids, s, a = ids[hit], s[hit], a[hit]
+        return ids, s, a + (self.b[ids] - a) * s[:, None]
+
+    def crossings(self, c, d):
+        """Crossings of the query segments c-d with the grid's segments.
+Returns (grid segment, query segment, s, t) with s the position along the
+grid segment and t along the query segment, both 0 to 1."""
+        c = np.asarray(c, dtype=np.float64).reshape(-1, 2)
+        d = np.asarray(d, dtype=np.float64).reshape(-1, 2)
+        i, j = self.candidates(c, d)
+        a = self.a[i]
+        r = self.b[i] - a
+        q = d[j] - c[j]
+        denom = cross2d(r, q)
+        ok = np.abs(denom) > 1e-12
+        denom = np.where(ok, denom, 1)
+        ac = c[j] - a
+        s = cross2d(ac, q) / denom
+        t = cross2d(ac, r) / denom
+        hit = ok & (s >= 0) & (s <= 1) & (t >= 0) & (t <= 1)
+        return i[hit], j[hit], s[hit], t[hit]
+
+def stroke_bounds(strokes):
+    """(S,2) lower and upper corners of the bounding boxes of a list of (n,2) strokes.
+Empty strokes get inverted boxes that overlap nothing."""
+    lo = np.full((len(strokes), 2), np.inf)
+    hi = np.full((len(strokes), 2), -np.inf)
+    filled = [i for i, s in enumerate(strokes) if len(s)]
+    if filled:
+        co = np.concatenate([strokes[i] for i in filled])
+        starts = np.cumsum([0] + [len(strokes[i]) for i in filled[:-1]])
+        lo[filled] = np.minimum.reduceat(co, starts, axis=0)
+        hi[filled] = np.maximum.reduceat(co, starts, axis=0)
+    return lo, hi
+
+def insert_points(values, segment, t):
+    """Insert points part way along segments, interpolating per point values.
+values is (n, ...), segment the sorted indices of the first point of each
+segment, where n - 1 is the closing segment of a cyclic stroke, and t the
+position along it. Returns the new values and the indices of the inserted points."""
+    values = np.asarray(values)
+    segment = np.asarray(segment, dtype=np.int64)
+    t = np.asarray(t).reshape((-1,) + (1,) * (values.ndim - 1))
+    start = values[segment]
+    new = start + (values[(segment + 1) % len(values)] - start) * t
+    at = segment + 1
+    return np.insert(values, at, new.astype(values.dtype), axis=0), at + np.arange(len(at))
+
+def split_pieces(count, inserted, cyclic = False):
+    """Point indices of the pieces a stroke of count points falls into when it is
+split at the inserted points, which end one piece and start the next."""
+    inserted = list(inserted)
+    if not inserted:
+        return [np.arange(count)]
+    if cyclic:
+        # the pieces run from cut to cut, the last one wrapping around the start
+        bounds = inserted + [inserted[0] + count]
+        pieces = [np.arange(a, b + 1) % count for a, b in zip(bounds[:-1], bounds[1:])]
+    else:
+        bounds = [0] + inserted + [count - 1]
+        pieces = [np.arange(a, b + 1) for a, b in zip(bounds[:-1], bounds[1:])]
+    return [piece for piece in pieces if len(piece) > 1]
+
+def random_strokes(count, rng, size = 10.0, step = 0.05, points = (2, 40)):
+    """Random walk strokes for tests and benchmarks."""
+    strokes = []
+    lengths = rng.integers(points[0], points[1], count)
+    starts = rng.uniform(-size, size, (count, 2))
+    steps = rng.normal(0, step, (lengths.sum(), 2))
+    for start, walk in zip(starts, np.split(steps, np.cumsum(lengths)[:-1])):
+        strokes.append(start + np.cumsum(walk, axis=0))
+    return strokes
+
+if __name__ == "__main__":
+    import time
+
+    def naive_cut(strokes, p1, p2):
+        # one segment at a time, the way the operator used to do it
+        hits = []
+        for sdx, co in enumerate(strokes):
+            for pdx in range(len(co) - 1):
+                a = co[pdx]
+                b = co[pdx + 1]
+                r = (p2[0] - p1[0], p2[1] - p1[1])
+                d = (b[0] - a[0], b[1] - a[1])
+                denom = r[0] * d[1] - r[1] * d[0]
+                if abs(denom) <= 1e-12:
+                    continue
+                ap = (a[0] - p1[0], a[1] - p1[1])
+                s = (ap[0] * d[1] - ap[1] * d[0]) / denom
+                t = (ap[0] * r[1] - ap[1] * r[0]) / denom
+                if 0 <= s <= 1 and 0 <= t < 1:
+                    hits.append((sdx, pdx))
+        return hits
+
+    rng = np.random.default_rng(1)
+    strokes = random_strokes(10000, rng)
+
+    t = time.perf_counter()
+    frame = CutFrame(strokes)
+    t1 = time.perf_counter()
+
+    lines = rng.uniform(-10, 10, (20, 2, 2))
+    results = [frame.cut(p1, p2) for p1, p2 in lines]
+    t2 = time.perf_counter()
+    hits = [naive_cut(strokes, p1, p2) for p1, p2 in lines[:3]]
+    t3 = time.perf_counter()
+
+    for (stroke, index, _, _), expected in zip(results, hits):
+        assert list(zip(stroke, index)) == expected
+
+    # inserted points land on the cut, splitting keeps the frame's bounds right
+    stroke, index, tt, points = results[0]
+    for i in np.unique(stroke)[::-1]:
+        sel = stroke == i
+        co, inserted = insert_points(strokes[i], index[sel], tt[sel])
+        assert len(co) == len(strokes[i]) + sel.sum() and np.allclose(co[inserted], points[sel])
+        pieces = split_pieces(len(co), inserted)
+        assert sum(map(len, pieces)) == len(co) + len(inserted)
+        for piece in pieces:
+            frame.append(co[piece])
+        frame.remove(i)
+    rebuilt = CutFrame(frame.strokes)
+    assert np.array_equal(rebuilt.lo, frame.lo) and np.array_equal(rebuilt.hi, frame.hi)
+
+    print("%d strokes, %d points: bounds %.1f ms, cut %.2f ms (%d crossings), per segment loop %.0f ms" %
+        (len(strokes), sum(map(len, strokes)), (t1 - t) * 1000, (t2 - t1) * 1000 / len(lines),
+        sum(len(r[0]) for r in results) / len(results), (t3 - t2) * 1000 / 3))
+
+    # knife paths against the whole frame
+    knives = [np.cumsum(rng.normal(0, 0.2, (300, 2)), axis=0) + rng.uniform(-5, 5, 2) for i in range(5)]
+    t4 = time.perf_counter()
+    knifeCuts = [frame.cut_path(path) for path in knives]
+    t5 = time.perf_counter()
+    for path, (stroke, index, tt, points) in zip(knives[:2], knifeCuts):
+        # the same crossings as cutting one knife segment at a time
+        found = set()
+        for k in range(len(path) - 1):
+            hit = frame.cut(path[k], path[k + 1])
+            for sdx, seg, u, pt in zip(*hit):
+                s = np.dot(pt - path[k], path[k + 1] - path[k]) / np.dot(path[k + 1] - path[k], path[k + 1] - path[k])
+                if s < 1 - 1e-12 or k == len(path) - 2:
+                    found.add((sdx, seg, round(u, 9)))
+        assert found == set(zip(stroke, index, np.round(tt, 9)))
+
+    print("knife of %d segments: %.1f ms, %d crossings" %
+        (len(knives[0]) - 1, (t5 - t4) * 1000 / len(knives), sum(len(c[0]) for c in knifeCuts) / len(knives)))
+
+    # live preview, one moving line against a grid of all the frame's segments
+    a, b, _, _ = frame.segments(range(len(frame)))
+    t6 = time.perf_counter()
+    grid = SegmentGrid(a, b)
+    t7 = time.perf_counter()
+    previews = [grid.line_crossings(p1, p2) for p1, p2 in lines]
+    t8 = time.perf_counter()
+    # lines[0] made the split pieces and runs exactly through their ends, leave it out
+    for (p1, p2), (_, _, found) in zip(lines[1:], previews[1:]):
+        assert len(frame.cut(p1, p2)[0]) == len(found)
+
+    print("preview over %d segments: grid %.1f ms, per mouse move %.2f ms" %
+        (len(grid), (t7 - t6) * 1000, (t8 - t7) * 1000 / len(lines)))
+
+    # a few long diagonals across a dense frame are kept out of the grid cells
+    walk = np.cumsum(rng.normal(0, 0.01, (98000, 2)), axis=0)
+    diagonals = np.array([[[-50, -50], [50, 50]], [[-50, 50], [50, -50]], [[-50, 0], [50, 1]]])
+    a = np.concatenate((walk[:-1], diagonals[:, 0]))
+    b = np.concatenate((walk[1:], diagonals[:, 1]))
+    t9 = time.perf_counter()
+    grid = SegmentGrid(a, b)
+    t10 = time.perf_counter()
+    assert len(grid.long) == len(diagonals) and len(grid.keys) < 4 * len(a)
+    lines = rng.uniform(walk.min(), walk.max(), (20, 2, 2))
+    previews = [grid.line_crossings(p1, p2) for p1, p2 in lines]
+    t11 = time.perf_counter()
+    for (p1, p2), (found, _, _) in zip(lines, previews):
+        hit, _ = segment_intersections(p1, p2, a, b)
+        assert set(found) == set(np.flatnonzero(hit))
+    i, j, _, _ = grid.crossings(lines[:, 0], lines[:, 1])
+    assert len(i) == sum(len(p[0]) for p in previews)
+
+    print("preview with %d long segments over %d: grid %.1f ms, %d cell entries, per mouse move %.2f ms" %
+        (len(grid.long), len(grid), (t10 - t9) * 1000, len(grid.keys), (t11 - t10) * 1000 / len(lines)))
@@ -17,13 +17,125 @@ from gpu_extras.batch import batch_for_shader
 from bpy_extras import view3d_utils
 from mathutils import Vector
 import mathutils
+import numpy as np
+from bpy.props import BoolProperty
+# helper modules shared by the add-ons, install them as add-on files next to this one
+try:
+    from gp_CutEngine import CutFrame, SegmentGrid, insert_points, split_pieces
+    from gp_Projection import location_3d_to_region_2d
+    from gp_FrameCache import FrameCache
+except ImportError as e:
+    raise ImportError("gp_CutStroke.py needs gp_CutEngine.py, gp_Projection.py and gp_FrameCache.py installed next to it: %s" % e) from e
+
+# point attributes carried over when points are inserted, with their sizes
+POINT_ATTRIBUTES = [('co', 3), ('pressure', 1), ('strength', 1), ('vertex_color', 4),
+                    ('uv_rotation', 1), ('uv_fill', 2), ('uv_factor', 1)]
+
+def stroke_coords(stroke): # the stroke's points on the XZ drawing plane
+    co = np.empty(len(stroke.points) * 3, dtype=np.float32)
+    stroke.points.foreach_get('co', co)
+    return co.reshape(-1, 3)[:, ::2]
+
+def read_points(stroke): # all point attributes of the stroke as (n, size) arrays
+    n = len(stroke.points)
+    values = {}
+    for name, size in POINT_ATTRIBUTES:
+        values[name] = np.empty(n * size, dtype=np.float32)
+        stroke.points.foreach_get(name, values[name])
+        values[name] = values[name].reshape(n, size)
+    values['select'] = np.empty(n, dtype=bool)
+    stroke.points.foreach_get('select', values['select'])
+    return values
+
+def write_points(stroke, values): # set all point attributes, adding points as needed
+    n = len(values['co'])
+    if n > len(stroke.points):
+        stroke.points.add(n - len(stroke.points))
+    for name, size in POINT_ATTRIBUTES:
+        stroke.points.foreach_set(name, np.ascontiguousarray(values[name], dtype=np.float32).ravel())
+    stroke.points.foreach_set('select', values['select'])
+
+# stroke attributes carried over to the pieces of a split stroke
+STROKE_ATTRIBUTES = ['line_width', 'material_index', 'hardness', 'vertex_color_fill', 'display_mode',
+                     'start_cap_mode', 'end_cap_mode', 'aspect', 'uv_rotation', 'uv_scale', 'uv_translation', 'select']
+
+def cut_points(stroke, segments, ts): # point attributes with selected, interpolated points inserted part way along segments
+    values = read_points(stroke)
+    for name, size in POINT_ATTRIBUTES:
+        values[name], inserted = insert_points(values[name], segments, ts)
+    values['select'] = np.insert(values['select'], np.asarray(segments) + 1, True)
+    return values, inserted
+
+def insert_stroke_points(stroke, segments, ts): # returns the new points on the XZ drawing plane
+    values, inserted = cut_points(stroke, segments, ts)
+    write_points(stroke, values)
+    return values['co'][:, ::2]
+
+def split_stroke(strokes, stroke, segments, ts): # replace stroke by its pieces between the cut points, returns the pieces on the XZ plane
+    values, inserted = cut_points(stroke, segments, ts)
+    pieces = []
+    
+    for piece in split_pieces(len(values['co']), inserted, stroke.use_cyclic):
+        newStroke = strokes.new()
+        for name in STROKE_ATTRIBUTES:
+            if hasattr(stroke, name):
+                setattr(newStroke, name, getattr(stroke, name))
+        newStroke.use_cyclic = False
+        write_points(newStroke, {name: v[piece] for name, v in values.items()})
+        pieces.append(values['co'][piece][:, ::2])
+        
+    strokes.remove(stroke)
+    return pieces
+
+cut_cache = FrameCache() # CutFrame of each keyframe, kept between cuts
+
+def cached_frame(gp, layer, frame): # the CutFrame of a frame, read on first use
+    key = FrameCache.key(gp, layer, frame)
+    cached = cut_cache.get(key)
+    if cached is None or len(cached) != len(frame.strokes):
+        strokes = frame.strokes
+        cached = cut_cache[key] = CutFrame([stroke_coords(s) for s in strokes], [s.use_cyclic for s in strokes])
+    return cached
+
+def cut_frames(context, allLayers): # (layer, frame) pairs to cut, respecting locking, visibility and multiframe editing
+    gpd = context.active_object.data
+    layers = [lr for lr in gpd.layers if not lr.lock and not lr.hide] if allLayers else [gpd.layers.active]
+    return [(lr, fr)
+        for lr in layers if lr
+            for fr in ([fr for fr in lr.frames if fr.select or fr == lr.active_frame] if gpd.use_multiedit else [lr.active_frame])
+                if fr]
+
+def cut_frame(gp, layer, frame, path, split): # cut one frame's strokes along the path, keeping its cached bounds up to date
+    cached = cached_frame(gp, layer, frame)
+    hits, segments, ts, _ = cached.cut_path(path)
+    if len(hits) == 0:
+        return 0
+    
+    # crossings are ordered by stroke, cut each stroke once, last first so
+    # the cached indices of the others stay valid
+    strokes = frame.strokes
+    strokeIds, firsts = np.unique(hits, return_index = True)
+    targets = [strokes[sdx] for sdx in strokeIds]
+    groups = np.split(np.arange(len(hits)), firsts[1:])
+    for sdx, s, sel in reversed(list(zip(strokeIds, targets, groups))):
+        if split:
+            for piece in split_stroke(strokes, s, segments[sel], ts[sel]):
+                cached.append(piece)
+            cached.remove(sdx)
+        else:
+            cached.replace(sdx, insert_stroke_points(s, segments[sel], ts[sel]))
+    
+    cut_cache.own_edit = True
+    return len(hits)
 
 def draw_callback_px(self, context):
     
-    if self.first:
-        lines = []
-        lines.append(self.first)
-        lines.append(self.mousepos)
+    if self.path:
+        lines = list(self.path)
+        if self.mousepos:
+            lines.append(self.mousepos)
+        if len(lines) < 2:
+            return
         # 50% alpha, 2 pixel width line
         shader = gpu.shader.from_builtin('UNIFORM_COLOR')
         gpu.state.blend_set('ALPHA')
@@ -32,6 +144,20 @@ def draw_callback_px(self, context):
         shader.uniform_float("color", (0.0, 0.0, 0.0, 0.5))
         batch.draw(shader)
 
+        # crossings of the placed path and of the line to the mouse, on the XZ plane
+        crossings = np.concatenate((self._markers, self._live))
+        if len(crossings):
+            co = np.zeros((len(crossings), 3))
+            co[:, 0] = crossings[:, 0]
+            co[:, 2] = crossings[:, 1]
+            xy, visible = location_3d_to_region_2d(context.region, context.space_data.region_3d, co)
+            if visible.any():
+                gpu.state.point_size_set(6)
+                batch = batch_for_shader(shader, 'POINTS', {"pos": xy[visible].tolist()})
+                shader.uniform_float("color", (1.0, 0.0, 0.0, 0.8))
+                batch.draw(shader)
+                gpu.state.point_size_set(1)
+
         # restore opengl defaults
         gpu.state.line_width_set(1.0)
         gpu.state.blend_set('NONE')
@@ -41,81 +167,67 @@ class CutStrokeOperator(bpy.types.Operator):
     """Cut visible strokes on the active layer"""
     bl_idname = "view3d.cutstroke_operator"
     bl_label = "Cut strokes Operator"
+    
+    split : BoolProperty(default=False, name = "Split Strokes", description = "Split the strokes into separate strokes at the cut", options={'SKIP_SAVE'})
+    all_layers : BoolProperty(default=False, name = "All Layers", description = "Cut all unlocked visible layers instead of only the active one", options={'SKIP_SAVE'})
+
+    @classmethod
+    def description(cls, context, properties):
+        txt = "Split visible strokes into separate strokes along a path" if properties.split else "Cut visible strokes along a path"
+        txt += " on all unlocked visible layers" if properties.all_layers else " on the active layer"
+        return txt + """.
+Drag to cut along a straight line, ALT-drag to cut along a freehand path.
+Hold CTRL when releasing to add a polyline point and continue the cut.
+Hold SHIFT when releasing to cut all unlocked visible layers.
+Cuts the selected keyframes too when multiframe editing is on."""
 
     @classmethod
     def poll(self, context):
         return (context.active_object.type == 'GPENCIL')
 
+    def plane_point(self, context, pos): # region pixel to the XZ drawing plane
+        pt = view3d_utils.region_2d_to_location_3d(context.region, context.space_data.region_3d, pos, (0,0,0))
+        return (pt[0], pt[2])
+
+    def add_point(self, context, pos): # extend the path, keeping the crossings of its segments for the preview
+        self.path.append(pos)
+        if len(self.path) > 1:
+            crossings = self._preview.line_crossings(self.plane_point(context, self.path[-2]), self.plane_point(context, pos))[2]
+            self._markers = np.concatenate((self._markers, crossings))
+        self._live = np.zeros((0, 2))
+
     def modal(self, context, event):
         context.area.tag_redraw()
 
         if event.type == 'MOUSEMOVE':
             self.mousepos = (event.mouse_region_x, event.mouse_region_y)
+            if self.freehand and self.path and (Vector(self.mousepos) - Vector(self.path[-1])).length >= 4:
+                self.add_point(context, self.mousepos)
+            elif self.path:
+                self._live = self._preview.line_crossings(self.plane_point(context, self.path[-1]), self.plane_point(context, self.mousepos))[2]
 
         elif event.type == 'LEFTMOUSE':
-            if self.first == None:
-                self.first = (event.mouse_region_x, event.mouse_region_y)
+            pos = (event.mouse_region_x, event.mouse_region_y)
+            
+            if event.value == 'PRESS':
+                if not self.path:
+                    self.add_point(context, pos)
+                    self.freehand = event.alt
                 return {'RUNNING_MODAL'}
-
-            self.last = (event.mouse_region_x, event.mouse_region_y)
             
-            area = context.area
-            space = area.spaces[0]
+            if not self.path:
+                return {'RUNNING_MODAL'}
             
-            for region in area.regions:
-                if region.type == 'WINDOW':
-                    break
-                
-            pt1 = view3d_utils.region_2d_to_location_3d(context.region, context.space_data.region_3d, 
-                (self.first[0], self.first[1]), (0,0,0))
-            pt2 = view3d_utils.region_2d_to_location_3d(context.region, context.space_data.region_3d, 
-                (self.last[0], self.last[1]), (0,0,0))
-                
-            lineA_p1 = Vector((pt1[0], pt1[2]))
-            lineA_p2 = Vector((pt2[0], pt2[2]))
-                
-            gp = context.active_object    
-            strokes = gp.data.layers.active.active_frame.strokes
+            self.add_point(context, pos)
             
-            for s in strokes:
-                cnt = len(s.points)
-                for pdx in range(cnt - 1, 0, -1):
-                    lineB_p1 = Vector((s.points[pdx - 1].co[0], s.points[pdx - 1].co[2]))
-                    lineB_p2 = Vector((s.points[pdx].co[0], s.points[pdx].co[2]))
-                    
-                    intersect_point = mathutils.geometry.intersect_line_line_2d(lineA_p1, lineA_p2, lineB_p1, lineB_p2)
-                    
-                    if intersect_point:
-                        
-                        s.points.add(1)
-                    
-                        for i in range( len(s.points) - 1, pdx, -1):
-                            s.points[i].uv_rotation = s.points[i - 1].uv_rotation
-                            s.points[i].uv_fill = s.points[i - 1].uv_fill
-                            s.points[i].uv_factor = s.points[i - 1].uv_factor
-                            
-                            s.points[i].pressure = s.points[i - 1].pressure
-                            s.points[i].strength = s.points[i - 1].strength
-                            s.points[i].vertex_color = s.points[i - 1].vertex_color
-                            
-                            s.points[i].co[0] = s.points[i - 1].co[0]
-                            s.points[i].co[1] = s.points[i - 1].co[1]
-                            s.points[i].co[2] = s.points[i - 1].co[2]
-                            s.points[i].select = s.points[i - 1].select
-                        
-
-                        s.points[pdx - 0].pressure = s.points[pdx].pressure
-                        s.points[pdx - 0].strength = s.points[pdx].strength
-                        s.points[pdx - 0].vertex_color = s.points[pdx].vertex_color
-                        s.points[pdx - 0].uv_rotation = s.points[pdx].uv_rotation
-                        s.points[pdx - 0].uv_fill = s.points[pdx].uv_fill
-                        s.points[pdx - 0].uv_factor = s.points[pdx].uv_factor
-                        
-                        s.points[pdx - 0].co[0] = intersect_point.x
-                        s.points[pdx - 0].co[1] = 0
-                        s.points[pdx - 0].co[2] = intersect_point.y
-                        s.points[pdx].select = True
-                                            
+            if event.ctrl and not self.freehand: # keep adding polyline points
+                return {'RUNNING_MODAL'}
+            
+            path = [self.plane_point(context, p) for p in self.path]
+                
+            gp = context.active_object
+            for layer, frame in cut_frames(context, self.all_layers or event.shift):
+                cut_frame(gp, layer, frame, path, self.split)
 
             bpy.types.SpaceView3D.draw_handler_remove(self._handle, 'WINDOW')
             return {'FINISHED'}
@@ -134,9 +246,25 @@ class CutStrokeOperator(bpy.types.Operator):
             # draw in view space with 'POST_VIEW' and 'PRE_VIEW'
             self._handle = bpy.types.SpaceView3D.draw_handler_add(draw_callback_px, args, 'WINDOW', 'POST_PIXEL')
 
-            self.first = None
+            self.path = []
+            self.freehand = False
             self.mousepos = None
 
+            # segments of the active frames for the live crossing preview, the
+            # frames do not change while the operator runs
+            gp = context.active_object
+            a = []
+            b = []
+            for layer, frame in cut_frames(context, self.all_layers):
+                if frame == layer.active_frame:
+                    cached = cached_frame(gp, layer, frame)
+                    sa, sb, _, _ = cached.segments(range(len(cached)))
+                    a.append(sa)
+                    b.append(sb)
+            self._preview = SegmentGrid(np.concatenate(a) if a else np.zeros((0, 2)), np.concatenate(b) if b else np.zeros((0, 2)))
+            self._markers = np.zeros((0, 2))
+            self._live = np.zeros((0, 2))
+
             context.window_manager.modal_handler_add(self)
             return {'RUNNING_MODAL'}
         else:
@@ -146,10 +274,12 @@ class CutStrokeOperator(bpy.types.Operator):
 
 def register():
     bpy.utils.register_class(CutStrokeOperator)
+    cut_cache.register()
 
 
 def unregister():
     bpy.utils.unregister_class(CutStrokeOperator)
+    cut_cache.unregister()
 
 
 if __name__ == "__main__":
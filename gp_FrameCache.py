@@ -0,0 +1,59 @@
+import bpy
+from bpy.app.handlers import persistent
+
+# Data read from the keyframes of grease pencil objects, kept between operator runs.
+# Entries are forgotten on undo, redo and file load, and when anything but the operator
+# that filled the cache edits the grease pencil data.
+
+class FrameCache(dict):
+    """(grease pencil data pointer, layer name, frame number) -> data read from that keyframe.
+
+    Set own_edit after changing the data so the depsgraph update it causes keeps the entries.
+    on_invalidate is called whenever entries are forgotten."""
+
+    def __init__(self, on_invalidate = None):
+        super().__init__()
+        self.own_edit = False
+        self.on_invalidate = on_invalidate
+
+        @persistent
+        def undo_handler(scene, *args):
+            self.invalidate()
+
+        @persistent
+        def depsgraph_handler(scene, depsgraph):
+            # the flag only covers the first update after the edit, even when nothing is cached
+            own, self.own_edit = self.own_edit, False
+            if own or not self:
+                return
+            cached = {key[0] for key in self}
+            for update in depsgraph.updates:
+                if isinstance(update.id, bpy.types.GreasePencil) and update.id.original.as_pointer() in cached:
+                    self.invalidate(update.id.original.as_pointer())
+
+        self._handlers = [
+            (bpy.app.handlers.undo_post, undo_handler),
+            (bpy.app.handlers.redo_post, undo_handler),
+            (bpy.app.handlers.load_post, undo_handler),
+            (bpy.app.handlers.depsgraph_update_post, depsgraph_handler),
+        ]
+
+    @staticmethod
+    def key(gp, layer, frame):
+        return (gp.data.as_pointer(), layer.info, frame.frame_number)
+
+    def invalidate(self, data = None): # forget the frames read from data, or from everything
+        for key in [key for key in self if data is None or key[0] == data]:
+            del self[key]
+        if self.on_invalidate:
+            self.on_invalidate()
+
+    def register(self):
+        for handlers, fn in self._handlers:
+            if fn not in handlers:
+                handlers.append(fn)
+
+    def unregister(self):
+        for handlers, fn in self._handlers:
+            if fn in handlers:
+                handlers.remove(fn)
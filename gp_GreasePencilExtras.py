@@ -448,6 +448,9 @@ class PGP_PT_sidebarPanel(bpy.types.Panel):
         row.alignment = 'CENTER'
         # Cut Strokes
         row.operator('view3d.cutstroke_operator', icon = "SNAP_MIDPOINT", text = "" ) 
+        op = row.operator('view3d.cutstroke_operator', icon = "MOD_EDGESPLIT", text = "" )
+        if op: # None when the Cut Stroke add-on is not enabled
+            op.split = True
         row.separator()
         # Snapigon
         row.operator('stroke.snapigon', icon = "SNAP_ON", text = "" )
@@ -460,6 +463,7 @@ class PGP_PT_sidebarPanel(bpy.types.Panel):
         row.separator()
         # Text
         row.operator("object.drawtext_operator", icon='EVENT_T', text='')
+        row.operator("object.drawtext_batch_operator", icon='FILE_TEXT', text='')
         # Set Stroke/Point Properties
         box = layout.box()
         row = box.row(align=True)
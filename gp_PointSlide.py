@@ -15,7 +15,12 @@ import blf
 import gpu
 from mathutils import Vector
 from gpu_extras.batch import batch_for_shader
-from bpy_extras import view3d_utils
+import numpy as np
+# helper modules shared by the add-ons, install them as add-on files next to this one
+try:
+    from gp_Projection import location_3d_to_region_2d
+except ImportError as e:
+    raise ImportError("gp_PointSlide.py needs gp_Projection.py installed next to it: %s" % e) from e
 
 from bpy.props import IntProperty, FloatProperty
 
@@ -70,7 +75,24 @@ def init_selected(context):
             if s.points[0].select and s.points[len(s.points) - 1].select:
                 selected_points.append( selected_points[stroke_start] )
             
-                            
+
+def selected_arrays(): # coordinates, normals and line segments of the selected_points strips
+    coords = []
+    normals = []
+    segments = []
+    start = True
+    for sp in selected_points:
+        if sp is None:
+            start = True
+            continue
+        if not start:
+            segments.append((len(coords) - 1, len(coords)))
+        start = False
+        coords.append(sp[2])
+        normals.append(sp[3])
+    return (np.array(coords, dtype=np.float64).reshape(-1, 3),
+        np.array(normals, dtype=np.float64).reshape(-1, 3),
+        np.array(segments, dtype=np.int32).reshape(-1, 2))
 
 def draw_callback_px(self, context):
     font_id = 0  # XXX, need to find out how best to get this.
@@ -94,16 +116,11 @@ def draw_callback_px(self, context):
         if region.type == 'WINDOW':
             break
         
-    lines = []
-    for sp in selected_points:
-        if sp == None:
-            batch = batch_for_shader(shader, 'LINE_STRIP', {"pos": lines})
-            batch.draw(shader)
-            lines.clear()
-            continue
-        lines.append(view3d_utils.location_3d_to_region_2d(region, space.region_3d, sp[2] + sp[3] * self.delta))
-    batch = batch_for_shader(shader, 'LINE_STRIP', {"pos": lines})
-    batch.draw(shader)
+    xy, visible = location_3d_to_region_2d(region, space.region_3d, self._coords + self._normals * self.delta)
+    segments = self._segments[visible[self._segments].all(axis=1)]
+    if len(segments) > 0:
+        batch = batch_for_shader(shader, 'LINES', {"pos": xy.astype(np.float32)}, indices=segments)
+        batch.draw(shader)
 
     # restore opengl defaults
     gpu.state.line_width_set(1.0)
@@ -155,6 +172,7 @@ class PointSlideOperator(bpy.types.Operator):
         if context.object.type == 'GPENCIL':
             
             init_selected(context)
+            self._coords, self._normals, self._segments = selected_arrays()
             self.first_mouse_x = event.mouse_x
             self.delta = 0.0
 
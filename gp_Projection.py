@@ -0,0 +1,72 @@
+import numpy as np
+
+# Array versions of bpy_extras.view3d_utils.location_3d_to_region_2d for the
+# modal operators, projecting all points of a preview or hit test at once.
+
+def project_points(matrix, width, height, points):
+    """Project (N,3) points to region pixels with a 4x4 perspective matrix.
+Returns (xy (N,2), visible (N,)), points behind the viewer are not visible."""
+    m = np.asarray(matrix, dtype=np.float64).reshape(4, 4)
+    p = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    prj = p @ m[:, :3].T + m[:, 3]
+    visible = prj[:, 3] > 0
+    w = np.where(visible, prj[:, 3], 1.0)
+    xy = np.empty((len(p), 2))
+    xy[:, 0] = width / 2 * (1 + prj[:, 0] / w)
+    xy[:, 1] = height / 2 * (1 + prj[:, 1] / w)
+    return xy, visible
+
+def view_key(region, rv3d):
+    """Hashable key of everything a projection depends on."""
+    m = np.asarray(rv3d.perspective_matrix, dtype=np.float64)
+    return (m.tobytes(), region.width, region.height)
+
+def location_3d_to_region_2d(region, rv3d, points):
+    """Project (N,3) points into region, returns (xy (N,2), visible (N,))."""
+    return project_points(rv3d.perspective_matrix, region.width, region.height, points)
+
+class ProjectedPoints:
+    """A point array together with its projection, redone only when the view changes."""
+
+    def __init__(self, points = None):
+        self.set_points(points)
+
+    def __len__(self):
+        return len(self.points)
+
+    def set_points(self, points):
+        if points is None:
+            points = np.zeros((0, 3))
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        self.xy = np.zeros((len(self.points), 2))
+        self.visible = np.zeros(len(self.points), dtype=bool)
+        self.key = None
+
+    def update(self, region, rv3d):
+        """Re-project if the view or region size changed, returns True if it did."""
+        key = view_key(region, rv3d)
+        if key == self.key:
+            return False
+        self.key = key
+        self.xy, self.visible = location_3d_to_region_2d(region, rv3d, self.points)
+        return True
+
+if __name__ == "__main__":
+    # compare with view3d_utils, run with: blender -b --python gp_Projection.py
+    from types import SimpleNamespace
+    from bpy_extras import view3d_utils
+    from mathutils import Matrix
+
+    rng = np.random.default_rng(1)
+    points = rng.uniform(-10, 10, (1000, 3))
+    for i in range(10):
+        persp = Matrix(rng.normal(size = (4, 4)).tolist()) # random views, with points on both sides
+        region = SimpleNamespace(width = 1920, height = 1080)
+        rv3d = SimpleNamespace(perspective_matrix = persp)
+
+        xy, visible = location_3d_to_region_2d(region, rv3d, points)
+        for p, q, v in zip(points, xy, visible):
+            ref = view3d_utils.location_3d_to_region_2d(region, rv3d, p)
+            assert (ref is None) == (not v)
+            assert ref is None or np.allclose(ref, q, atol = 1e-3)
+    print("projection matches view3d_utils")
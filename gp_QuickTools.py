@@ -12,22 +12,17 @@ bl_info = {
 
 import bpy
 import gpu
+import numpy as np
 from bpy.props import StringProperty
 
 from bpy_extras import view3d_utils
 from mathutils import Vector
-
-def s2lin(x): # convert srgb to linear
-    a = 0.055
-    if x <= 0.04045:
-        y = x * (1.0 /12.92)
-    else:
-        y = pow ( (x + a) * (1.0 / (1 + a)), 2.4)
-    return y
-
-def cmp(clr1, clr2):
-    delta = 0.03
-    return abs(clr1[0] - clr2[0]) < delta and abs(clr1[1] - clr2[1]) < delta and abs(clr1[2] - clr2[2]) < delta
+# helper modules shared by the add-ons, install them as add-on files next to this one
+try:
+    from gp_Color import srgb_to_linear_rgba
+    from gp_create_materials import create_palette_materials, quickCreateMaterialsOperator
+except ImportError as e:
+    raise ImportError("gp_QuickTools.py needs gp_Color.py and gp_create_materials.py installed next to it: %s" % e) from e
 
 def getPixel(X, Y):
     fb = gpu.state.active_framebuffer_get()
@@ -54,6 +49,8 @@ class SetQuickToolOperator(bpy.types.Operator):
         tooltips = dict(LINKED = 'Select all points on selected strokes',
             LAYER = 'Highlight layer selected stroke is on',
             FILL = "Set Vertex Replace color to selected strokes on the active keyframe",
+            CREATE_MATERIALS = "Create a material for each stroke and fill vertex color",
+            CREATE_PALETTE = "Reduce all stroke and fill vertex colors to a palette of at most Palette Size materials",
         )
 
         args = properties.args.split('|')
@@ -113,80 +110,6 @@ class SetQuickToolOperator(bpy.types.Operator):
         r3d.view_camera_zoom = 30 + 10 / rw
         
 
-    def createMaterialsFromStrokes(self, context):
-        gp = context.active_object
-        
-        for layer in gp.data.layers:
-            for frame in layer.frames:
-                for stroke in frame.strokes:
-                    if len(stroke.points) == 0 : continue
-                
-                    mat_index = stroke.material_index
-                    vertex_color = vertex_color_fill = None
-                    if gp.data.materials[mat_index].grease_pencil.show_fill:
-                        vertex_color_fill = stroke.vertex_color_fill
-                    if gp.data.materials[mat_index].grease_pencil.show_stroke:
-                        vertex_color = stroke.points[0].vertex_color     
-
-                    # skip strokes drawn with material color
-                    if (vertex_color_fill and stroke.vertex_color_fill[3] == 0) and \
-                        (vertex_color and stroke.points[0].vertex_color[3] == 0):
-                        continue
-
-                    bFound = False
-                    
-                    for idx in range(0, len(gp.data.materials)):
-                        mat = gp.data.materials[idx].grease_pencil
-                        
-                        mc = [ mat.color[0], mat.color[1], mat.color[2] ]
-                        mf = [ mat.fill_color[0], mat.fill_color[1], mat.fill_color[2] ]
-
-                        if vertex_color and not vertex_color_fill:
-                            sc = [ vertex_color[0], vertex_color[1], vertex_color[2] ]
-                            if mat.show_stroke and not mat.show_fill and cmp(sc, mc):
-                                stroke.material_index = idx
-                                bFound = True
-                                break
-                                
-                        if vertex_color_fill and not vertex_color:
-                            sf = [ vertex_color_fill[0], vertex_color_fill[1], vertex_color_fill[2]]
-                            if mat.show_fill and not mat.show_stroke and cmp(sf, mf):
-                                stroke.material_index = idx
-                                bFound = True
-                                break
-                            
-                        if vertex_color and vertex_color_fill:
-                            sc = [ vertex_color[0], vertex_color[1], vertex_color[2] ]
-                            sf = [ vertex_color_fill[0], vertex_color_fill[1], vertex_color_fill[2]]
-                            if mat.show_stroke and mat.show_fill and cmp(sc, mc) and cmp(sf, mf):
-                                stroke.material_index = idx
-                                bFound = True
-                                break
-                                    
-                    if bFound == False:
-                        # create new material    
-                        gp_mat = bpy.data.materials.new("COLOR" + str( len(gp.data.materials) + 1) )
-
-                        if not gp_mat.is_grease_pencil:
-                            bpy.data.materials.create_gpencil_data(gp_mat)
-                            if vertex_color:
-                                gp_mat.grease_pencil.color = (vertex_color[0], vertex_color[1], vertex_color[2], 1)
-                                gp_mat.grease_pencil.show_stroke=True
-                            else:
-                                gp_mat.grease_pencil.show_stroke=False
-                            
-                            if vertex_color_fill:
-                                gp_mat.grease_pencil.fill_color = (vertex_color_fill[0], vertex_color_fill[1], vertex_color_fill[2], 1) 
-                                gp_mat.grease_pencil.show_fill=True
-                            else:
-                                gp_mat.grease_pencil.show_fill=False
-
-                        gp.data.materials.append(gp_mat)
-                        stroke.material_index = len(gp.data.materials) - 1
-                        stroke.vertex_color_fill[3] = 0
-                        stroke.points[0].vertex_color[3] ==0
-                        
-                                
     def execute(self, context):
         
         mode, cmd = self.args.split('|')
@@ -212,7 +135,10 @@ class SetQuickToolOperator(bpy.types.Operator):
             elif cmd == 'FRAME':
                 self.frameSelection(context)
             elif cmd == 'CREATE_MATERIALS':
-                self.createMaterialsFromStrokes(context)
+                bpy.ops.quicktools.create_materials('INVOKE_DEFAULT')
+            elif cmd == 'CREATE_PALETTE':
+                changed, mean, largest = create_palette_materials(context.active_object, context.scene.quicktools_palette_size)
+                self.report({'INFO'}, "%d strokes reassigned, color error mean %.4f max %.4f" % (changed, mean, largest))
             elif cmd == 'LAYER':
                 gp = context.active_object
                 for idx, lr in enumerate(gp.data.layers):
@@ -222,13 +148,16 @@ class SetQuickToolOperator(bpy.types.Operator):
                             break
             elif cmd == 'FILL':
                 gp = context.active_object
-                clr = bpy.data.brushes['Vertex Replace'].color
+                clr = srgb_to_linear_rgba(bpy.data.brushes['Vertex Replace'].color)
                 
                 for lr in gp.data.layers:
+                    if not lr.active_frame:
+                        continue
                     for s in lr.active_frame.strokes:
-                        for p in s.points:
-                            if p.select:
-                                 s.vertex_color_fill = (s2lin(clr[0]), s2lin(clr[1]), s2lin(clr[2]), 1)
+                        select = np.zeros(len(s.points), dtype=bool)
+                        s.points.foreach_get('select', select)
+                        if select.any():
+                            s.vertex_color_fill = clr
                                  
             else: # change to edit mode to run stroke commands, return to previous mode after
                 _mode = context.active_object.mode
@@ -495,8 +424,11 @@ class QuickToolsPanel(bpy.types.Panel):
         row.operator("quicktools.set_quicktool", icon = "IMPORT").args = "OPS|SEND_TO_BACK"
         
         row = layout.box().row()
-        row.operator("quicktools.set_quicktool", text = "Create Materials").args = "OPS|CREATE_MATERIALS"
+        row.operator("quicktools.create_materials", text = "Create Materials")
         row.operator('quicktools.eyedropper', icon = 'EYEDROPPER', text = "")
+        row = layout.box().row(align=True)
+        row.operator("quicktools.set_quicktool", text = "Create Palette").args = "OPS|CREATE_PALETTE"
+        row.prop(context.scene, "quicktools_palette_size", text = "")
         
         box = layout.box()
         row = box.row()
@@ -593,15 +525,18 @@ _classes = [
     quickToggleFullScreenOperator,
     quickEyeDropperOperator,
     quickSampleStrokesOperator,
+    quickCreateMaterialsOperator,
     QuickToolsPanel
 ]
 
 def register():
+    bpy.types.Scene.quicktools_palette_size = bpy.props.IntProperty(name="Palette Size", description="Largest number of materials Create Palette makes, it always makes one for each kind of stroke, fill or both present", default=16, min=1, max=256)
     for cls in _classes:
         bpy.utils.register_class(cls)
 
 
 def unregister():
+    del bpy.types.Scene.quicktools_palette_size
     for cls in _classes:
         bpy.utils.unregister_class(cls)
 
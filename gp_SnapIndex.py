@@ -0,0 +1,341 @@
+import numpy as np
+from gp_Projection import project_points
+
+# Screen-space lookup of snap candidates for the modal drawing operators.
+# Candidates are kept as world-space coordinates, projected to region pixels
+# once per view change and bucketed into a uniform grid, so a cursor query
+# only has to look at the few cells around the mouse.
+
+class SnapIndex:
+    """Uniform pixel grid over projected candidate points."""
+
+    def __init__(self, points = None, cell = 16):
+        self.cell = cell
+        self.set_points(points)
+
+    def __len__(self):
+        return len(self.points)
+
+    def set_points(self, points, ids = None):
+        """Replace the candidates, ids holds one row of integer ids per point."""
+        if points is None:
+            points = np.zeros((0, 3))
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        self.ids = self._ids_for(self.points, ids, 1)
+        self.xy = np.zeros((len(self.points), 2))
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._view = None
+
+    def append(self, points, ids = None):
+        """Add candidates, projecting and filing only the new points."""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        start = len(self.points)
+        self.points = np.concatenate((self.points, points))
+        self.ids = np.concatenate((self.ids, self._ids_for(points, ids, self.ids.shape[1])))
+        if self._view is None:
+            self.xy = np.concatenate((self.xy, np.zeros((len(points), 2))))
+            return
+
+        xy, visible = project_points(self._matrix, self._width, self._height, points)
+        self.xy = np.concatenate((self.xy, xy))
+        keys, ids = self._cell_keys(xy, visible)
+        order = np.argsort(keys, kind='stable')
+        at = np.searchsorted(self._keys, keys[order], 'right')
+        self._keys = np.insert(self._keys, at, keys[order])
+        self._ids = np.insert(self._ids, at, ids[order] + start)
+
+    def _ids_for(self, points, ids, columns):
+        if ids is None:
+            return np.zeros((len(points), columns), dtype=np.int32)
+        return np.asarray(ids, dtype=np.int32)
+
+    def _cell_keys(self, xy, visible):
+        # grid keys of the points on screen plus a margin of one cell
+        c = self.cell
+        visible = visible & (xy[:, 0] >= -c) & (xy[:, 0] < self._width + c)
+        visible &= (xy[:, 1] >= -c) & (xy[:, 1] < self._height + c)
+        ids = np.flatnonzero(visible)
+        cx = ((xy[ids, 0] + c) // c).astype(np.int64)
+        cy = ((xy[ids, 1] + c) // c).astype(np.int64)
+        return cy * self._cols + cx, ids
+
+    def update(self, matrix, width, height):
+        """Re-project the candidates if the view changed since the last call."""
+        m = np.asarray(matrix, dtype=np.float64).reshape(4, 4)
+        view = (m.tobytes(), width, height)
+        if view == self._view:
+            return False
+        self._view = view
+        self._matrix = m
+        self._width = width
+        self._height = height
+        self._cols = int(width // self.cell) + 3
+        self._rows = int(height // self.cell) + 3
+
+        self.xy, visible = project_points(m, width, height, self.points)
+        keys, ids = self._cell_keys(self.xy, visible)
+        order = np.argsort(keys, kind='stable')
+        self._keys = keys[order]
+        self._ids = ids[order]
+        return True
+
+    def query(self, pos, radius):
+        """Ids of the candidates in the grid cells within radius of pos."""
+        if self._view is None or len(self._ids) == 0:
+            return self._ids[:0]
+        c = self.cell
+        x0 = max(int((pos[0] - radius + c) // c), 0)
+        x1 = min(int((pos[0] + radius + c) // c), self._cols - 1)
+        y0 = max(int((pos[1] - radius + c) // c), 0)
+        y1 = min(int((pos[1] + radius + c) // c), self._rows - 1)
+        if x0 > x1 or y0 > y1:
+            return self._ids[:0]
+
+        rows = np.arange(y0, y1 + 1) * self._cols
+        lo = np.searchsorted(self._keys, rows + x0, 'left')
+        hi = np.searchsorted(self._keys, rows + x1, 'right')
+        return np.concatenate([self._ids[a:b] for a, b in zip(lo, hi)])
+
+    def nearest(self, pos, radius):
+        """Index of the candidate closest to pos, closer than radius pixels, or -1."""
+        ids = self.query(pos, radius)
+        if len(ids) == 0:
+            return -1
+        d = np.sum((self.xy[ids] - np.asarray(pos, dtype=np.float64)) ** 2, axis=1)
+        i = np.argmin(d)
+        if d[i] >= radius * radius:
+            return -1
+        return int(ids[i])
+
+def _spread_bits(x):
+    # interleave zeros between the low 16 bits of x
+    x = x.astype(np.uint32)
+    x = (x | (x << 8)) & 0x00FF00FF
+    x = (x | (x << 4)) & 0x0F0F0F0F
+    x = (x | (x << 2)) & 0x33333333
+    x = (x | (x << 1)) & 0x55555555
+    return x
+
+class SegmentTree:
+    """Bounding volume hierarchy over 2D segments.
+A complete binary tree over Morton ordered leaves of LEAF segments, stored as
+one array of boxes per level so queries walk it a level at a time."""
+
+    LEAF = 8
+
+    def __init__(self, a, b):
+        a = np.asarray(a, dtype=np.float64).reshape(-1, 2)
+        b = np.asarray(b, dtype=np.float64).reshape(-1, 2)
+        self.count = n = len(a)
+        self.levels = []
+        self.order = np.zeros(0, dtype=np.int64)
+        if n == 0:
+            return
+
+        lo = np.minimum(a, b)
+        hi = np.maximum(a, b)
+        c = (lo + hi) / 2
+        cmin = c.min(axis=0)
+        span = np.maximum(c.max(axis=0) - cmin, 1e-12)
+        q = ((c - cmin) / span * 65535).astype(np.uint32)
+        self.order = np.argsort(_spread_bits(q[:, 0]) | (_spread_bits(q[:, 1]) << 1), kind='stable')
+        self.lo = lo[self.order]
+        self.hi = hi[self.order]
+
+        leaves = -(-n // self.LEAF)
+        size = 1 << (leaves - 1).bit_length()
+        nlo = np.full((size, 2), np.inf)
+        nhi = np.full((size, 2), -np.inf)
+        starts = np.arange(0, n, self.LEAF)
+        nlo[:leaves] = np.minimum.reduceat(self.lo, starts, axis=0)
+        nhi[:leaves] = np.maximum.reduceat(self.hi, starts, axis=0)
+        self.levels.append((nlo, nhi))
+        while len(nlo) > 1:
+            nlo = np.minimum(nlo[0::2], nlo[1::2])
+            nhi = np.maximum(nhi[0::2], nhi[1::2])
+            self.levels.append((nlo, nhi))
+        self.levels.reverse()
+
+    def query(self, lo, hi):
+        """Ids of the segments whose bounding boxes overlap the box lo, hi."""
+        if self.count == 0:
+            return self.order
+        nodes = np.zeros(1, dtype=np.int64)
+        for level, (nlo, nhi) in enumerate(self.levels):
+            if level > 0:
+                nodes = np.stack((nodes * 2, nodes * 2 + 1), axis=1).ravel()
+            nodes = nodes[np.all((nlo[nodes] <= hi) & (nhi[nodes] >= lo), axis=1)]
+            if len(nodes) == 0:
+                return self.order[:0]
+        ids = (nodes[:, None] * self.LEAF + np.arange(self.LEAF)).ravel()
+        ids = ids[ids < self.count]
+        ids = ids[np.all((self.lo[ids] <= hi) & (self.hi[ids] >= lo), axis=1)]
+        return self.order[ids]
+
+def stroke_segment_ends(points, lengths, cyclic):
+    """Start and end points of the segments of strokes stored back to back in points."""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    starts = np.cumsum(lengths) - lengths
+    # every point except a stroke's last starts a segment, cyclic strokes close back to their first
+    first = np.ones(len(points), dtype=bool)
+    first[(starts + lengths - 1)[lengths > 0]] = False
+    i = np.flatnonzero(first)
+    closed = np.asarray(cyclic, dtype=bool) & (lengths > 2)
+    i0 = np.concatenate((i, starts[closed] + lengths[closed] - 1))
+    i1 = np.concatenate((i + 1, starts[closed]))
+    return points[i0], points[i1]
+
+class SegmentIndex:
+    """Stroke segments on the XZ drawing plane, for snapping to edges and intersections.
+The tree is built on first use. Segments appended later are tested directly
+until there are enough of them to be worth rebuilding it."""
+
+    REBUILD = 4096
+
+    def __init__(self):
+        self.set_strokes(None, [], [])
+
+    def __len__(self):
+        return len(self.a)
+
+    def set_strokes(self, points, lengths, cyclic):
+        if points is None:
+            points = np.zeros((0, 3))
+        self.a, self.b = stroke_segment_ends(points, lengths, cyclic)
+        self._tree = None
+
+    def append_stroke(self, points, cyclic = False):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        a, b = stroke_segment_ends(points, [len(points)], [cyclic])
+        self.a = np.concatenate((self.a, a))
+        self.b = np.concatenate((self.b, b))
+
+    def _near(self, pos, radius):
+        # ids, parameters and distances of the segments passing within radius of pos
+        if self._tree is None or len(self.a) - self._tree.count > self.REBUILD:
+            self._tree = SegmentTree(self.a[:, ::2], self.b[:, ::2])
+        pos = np.asarray(pos, dtype=np.float64)
+        lo = pos - radius
+        hi = pos + radius
+        ids = self._tree.query(lo, hi)
+        extra = np.arange(self._tree.count, len(self.a))
+        if len(extra):
+            a = self.a[extra][:, ::2]
+            b = self.b[extra][:, ::2]
+            hit = np.all((np.minimum(a, b) <= hi) & (np.maximum(a, b) >= lo), axis=1)
+            ids = np.concatenate((ids, extra[hit]))
+
+        a = self.a[ids][:, ::2]
+        d = self.b[ids][:, ::2] - a
+        dd = np.maximum(np.sum(d * d, axis=1), 1e-24)
+        t = np.clip(np.sum((pos - a) * d, axis=1) / dd, 0, 1)
+        dist = np.hypot(*(a + d * t[:, None] - pos).T)
+        near = dist < radius
+        return ids[near], t[near], dist[near]
+
+    def _point(self, i, t):
+        return tuple(self.a[i] + (self.b[i] - self.a[i]) * t)
+
+    def nearest_point(self, pos, radius):
+        """Closest point on any segment within radius of pos (x, z), as a 3D tuple, or None."""
+        ids, t, dist = self._near(pos, radius)
+        if len(ids) == 0:
+            return None
+        k = np.argmin(dist)
+        return self._point(ids[k], t[k])
+
+    def nearest_intersection(self, pos, radius):
+        """Closest crossing of two segments within radius of pos (x, z), as a 3D tuple, or None."""
+        ids, _, _ = self._near(pos, radius)
+        if len(ids) < 2:
+            return None
+        a = self.a[ids][:, ::2]
+        r = self.b[ids][:, ::2] - a
+
+        # all pairs, a[i] + t * r[i] == a[j] + u * r[j]
+        cross = lambda p, q: p[..., 0] * q[..., 1] - p[..., 1] * q[..., 0]
+        denom = cross(r[:, None], r[None, :])
+        ok = np.abs(denom) > 1e-12
+        denom = np.where(ok, denom, 1)
+        ab = a[None, :] - a[:, None]
+        t = cross(ab, r[None, :]) / denom
+        u = cross(ab, r[:, None]) / denom
+        # crossings inside both segments, shared end points of neighbours are not crossings
+        eps = 1e-9
+        ok &= (t > eps) & (t < 1 - eps) & (u > eps) & (u < 1 - eps)
+        ok &= np.triu(np.ones(ok.shape, dtype=bool), 1)
+        i, j = np.nonzero(ok)
+        if len(i) == 0:
+            return None
+        t = t[i, j]
+        dist = np.hypot(*(a[i] + r[i] * t[:, None] - np.asarray(pos)).T)
+        k = np.argmin(dist)
+        if dist[k] >= radius:
+            return None
+        return self._point(ids[i[k]], t[k])
+
+if __name__ == "__main__":
+    import time
+
+    rng = np.random.default_rng(1)
+    points = rng.uniform(-10, 10, (200000, 3))
+    m = np.identity(4)
+    m[:3, :3] *= 0.1
+    m[3, 2] = -1 / 20
+    m[3, 3] = 1
+
+    index = SnapIndex(points)
+    t = time.perf_counter()
+    index.update(m, 1920, 1080)
+    t1 = time.perf_counter()
+
+    mouse = rng.uniform((0, 0), (1920, 1080), (1000, 2))
+    found = [index.nearest(pos, 8) for pos in mouse]
+    t2 = time.perf_counter()
+
+    xy, visible = project_points(m, 1920, 1080, points)
+    for pos, i in zip(mouse[:100], found):
+        d = np.where(visible, np.hypot(*(xy - pos).T), np.inf)
+        j = np.argmin(d)
+        assert (i == -1 and d[j] >= 8) or d[i] == d[j]
+
+    # appending matches a full rebuild
+    more = rng.uniform(-10, 10, (500, 3))
+    index.append(more)
+    whole = SnapIndex(np.concatenate((points, more)))
+    whole.update(m, 1920, 1080)
+    assert np.array_equal(index._keys, whole._keys) and np.array_equal(index._ids, whole._ids)
+
+    print("%d points: build %.1f ms, query %.1f us" %
+        (len(points), (t1 - t) * 1000, (t2 - t1) * 1e6 / len(mouse)))
+
+    # random walk strokes on the XZ plane
+    lengths = rng.integers(2, 40, 2000)
+    steps = rng.normal(0, 0.05, (lengths.sum(), 3))
+    steps[:, 1] = 0
+    steps[np.cumsum(lengths) - lengths] = rng.uniform(-10, 10, (len(lengths), 3)) * (1, 0, 1)
+    points = np.cumsum(steps, axis=0)
+    starts = np.cumsum(lengths) - lengths
+    points -= np.repeat(points[starts] - steps[starts], lengths, axis=0)
+
+    segments = SegmentIndex()
+    segments.set_strokes(points, lengths, np.zeros(len(lengths), dtype=bool))
+    t = time.perf_counter()
+    segments._near((0, 0), 0.1)
+    t1 = time.perf_counter()
+    cursor = rng.uniform(-10, 10, (1000, 2))
+    edge = [segments.nearest_point(pos, 0.1) for pos in cursor]
+    cross = [segments.nearest_intersection(pos, 0.1) for pos in cursor]
+    t2 = time.perf_counter()
+
+    a = segments.a[:, ::2]
+    d = segments.b[:, ::2] - a
+    for pos, q in zip(cursor[:100], edge):
+        tt = np.clip(np.sum((pos - a) * d, axis=1) / np.maximum(np.sum(d * d, axis=1), 1e-24), 0, 1)
+        dist = np.hypot(*(a + d * tt[:, None] - pos).T)
+        assert (q is None and dist.min() >= 0.1) or np.isclose(np.hypot(q[0] - pos[0], q[2] - pos[1]), dist.min())
+
+    print("%d segments: build %.1f ms, edge and intersection query %.1f us, %d crossings found" %
+        (len(segments), (t1 - t) * 1000, (t2 - t1) * 1e6 / len(cursor), sum(c is not None for c in cross)))
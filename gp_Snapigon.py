@@ -18,16 +18,20 @@ from mathutils import Vector
 from gpu_extras.presets import draw_circle_2d
 from gpu_extras.batch import batch_for_shader
 import gpu
+import numpy as np
+from bpy.props import BoolProperty, EnumProperty
+# helper modules shared by the add-ons, install them as add-on files next to this one
+try:
+    from gp_Color import srgb_to_linear_rgba
+    from gp_SnapIndex import SnapIndex, SegmentIndex
+    from gp_Projection import ProjectedPoints
+    from gp_FrameCache import FrameCache
+except ImportError as e:
+    raise ImportError("gp_Snapigon.py needs gp_Color.py, gp_SnapIndex.py, gp_Projection.py and gp_FrameCache.py installed next to it: %s" % e) from e
 
-startend_points = []
-
-def s2lin(x): # convert srgb to linear
-    a = 0.055
-    if x <= 0.04045:
-        y = x * (1.0 /12.92)
-    else:
-        y = pow ( (x + a) * (1.0 / (1 + a)), 2.4)
-    return y
+startend_points = SnapIndex()
+snap_segments = SegmentIndex()
+snap_source = None # key of the layer frames and filters startend_points was put together from, None when it has to be rebuilt
 
 def to3d(context, pos2d): # helper function to convert 2d point to 3d
     return view3d_utils.region_2d_to_location_3d(context.region, context.space_data.region_3d, 
@@ -36,25 +40,148 @@ def to3d(context, pos2d): # helper function to convert 2d point to 3d
 def to2d(context, pos3d): # helper function to convert 3d point to 2d
     return view3d_utils.location_3d_to_region_2d(context.region, context.space_data.region_3d, pos3d)
                 
-def init_startendpoints(context): # create array of start and end points of all visible strokes
+class FrameCandidates: # points of the strokes on one keyframe of a layer
+    def __init__(self, frame):
+        coords = []
+        strokes = []
+        lengths = []
+        cyclic = []
+        for sdx, s in enumerate(frame.strokes):
+            count = len(s.points)
+            if count > 0:
+                co = np.empty(count * 3, dtype=np.float32)
+                s.points.foreach_get('co', co)
+                coords.append(co)
+                strokes.append(sdx)
+                lengths.append(count)
+                cyclic.append(s.use_cyclic)
+        self.coords = np.concatenate(coords).reshape(-1, 3) if coords else np.zeros((0, 3), dtype=np.float32)
+        self.strokes = np.array(strokes, dtype=np.int32)
+        self.lengths = np.array(lengths, dtype=np.int64)
+        self.cyclic = np.array(cyclic, dtype=bool)
+        
+    def add_stroke(self, sdx, coords, cyclic):
+        coords = np.asarray(coords, dtype=np.float32).reshape(-1, 3)
+        self.coords = np.concatenate((self.coords, coords))
+        self.strokes = np.append(self.strokes, np.int32(sdx))
+        self.lengths = np.append(self.lengths, len(coords))
+        self.cyclic = np.append(self.cyclic, cyclic)
+        
+    def ids(self): # (stroke, point) of every point
+        starts = np.cumsum(self.lengths) - self.lengths
+        ids = np.empty((len(self.coords), 2), dtype=np.int32)
+        ids[:, 0] = np.repeat(self.strokes, self.lengths)
+        ids[:, 1] = np.arange(len(ids)) - np.repeat(starts, self.lengths)
+        return ids
+        
+    def endpoints(self): # mask of the first and last point of every stroke
+        mask = np.zeros(len(self.coords), dtype=bool)
+        ends = np.cumsum(self.lengths)
+        mask[ends - self.lengths] = True
+        mask[ends - 1] = True
+        return mask
+
+def snap_layer_frames(context, layers, neighbors): # (layer index, layer, keyframe) allowed by the filters
+    gpd = context.active_object.data
+    current = context.scene.frame_current
+    active = gpd.layers.active_index
+    result = []
+    
+    for ldx, lr in enumerate(gpd.layers):
+        if lr.hide:
+            continue
+        if layers == 'ACTIVE' and ldx != active:
+            continue
+        if layers == 'SELECTED' and ldx != active and not lr.select:
+            continue
+        before = after = None
+        for fr in lr.frames:
+            n = fr.frame_number
+            if n == current:
+                result.append((ldx, lr, fr))
+            elif n < current and (before is None or n > before.frame_number):
+                before = fr
+            elif n > current and (after is None or n < after.frame_number):
+                after = fr
+        if neighbors:
+            result += [(ldx, lr, fr) for fr in (before, after) if fr]
+            
+    return result
+
+def init_startendpoints(context, filters): # put the snap candidates together from the layer frames the filters allow
+    global snap_source
+    
     gp = context.active_object
     
     if gp.type != 'GPENCIL':
         return
     
-    startend_points.clear()
+    layers, endpoints, neighbors = filters
+    data = gp.data.as_pointer()
+    frames = snap_layer_frames(context, layers, neighbors)
+    source = (data, tuple((ldx, lr.info, fr.frame_number) for ldx, lr, fr in frames), endpoints)
+    if source == snap_source:
+        return
+    snap_source = source
     
-    for lr in gp.data.layers:
-        if lr.hide:
-            continue
-        for fr in lr.frames:
-            if fr.frame_number == context.scene.frame_current:
-                for s in fr.strokes:
-                    if len(s.points) > 0:
-                        #startend_points.append(s.points[0])
-                        #startend_points.append(s.points[-1])
-                        for p in s.points:
-                            startend_points.append(p)
+    entries = []
+    for ldx, lr, fr in frames:
+        key = (data, lr.info, fr.frame_number)
+        if key not in snap_frames:
+            snap_frames[key] = FrameCandidates(fr)
+        entries.append((ldx, snap_frames[key]))
+    
+    # (layer, stroke, point) ids of every candidate
+    coords = [np.zeros((0, 3), dtype=np.float32)]
+    ids = [np.zeros((0, 3), dtype=np.int32)]
+    for ldx, entry in entries:
+        keep = entry.endpoints() if endpoints else slice(None)
+        coords.append(entry.coords[keep])
+        ids.append(np.column_stack((np.full(len(entry.coords), ldx, dtype=np.int32), entry.ids()))[keep])
+    startend_points.set_points(np.concatenate(coords), np.concatenate(ids))
+    
+    snap_segments.set_strokes(
+        np.concatenate([entry.coords for ldx, entry in entries] + [np.zeros((0, 3))]),
+        np.concatenate([entry.lengths for ldx, entry in entries] + [np.zeros(0, dtype=np.int64)]),
+        np.concatenate([entry.cyclic for ldx, entry in entries] + [np.zeros(0, dtype=bool)]))
+
+def invalidate_startendpoints(): # put the candidates together again on the next snap
+    global snap_source
+    snap_source = None
+
+snap_frames = FrameCache(invalidate_startendpoints) # FrameCandidates of each keyframe, kept between invocations
+
+def find_snap_point(context, pos, pixels, filters): # nearest candidate within pixels of pos, as (3d, 2d) or None
+    if snap_source is None:
+        init_startendpoints(context, filters)
+    rv3d = context.space_data.region_3d
+    startend_points.update(rv3d.perspective_matrix, context.region.width, context.region.height)
+    i = startend_points.nearest(pos, pixels)
+    if i < 0:
+        return None
+    return tuple(startend_points.points[i]), tuple(startend_points.xy[i])
+
+def find_edge_point(context, pos, pixels, filters): # nearest crossing or point on a stroke segment within pixels of pos, as (3d, 2d) or None
+    if snap_source is None:
+        init_startendpoints(context, filters)
+    p0 = to3d(context, pos)
+    radius = (to3d(context, (pos[0] + pixels, pos[1])) - p0).length
+    p3d = snap_segments.nearest_intersection((p0.x, p0.z), radius) or snap_segments.nearest_point((p0.x, p0.z), radius)
+    if p3d is None:
+        return None
+    p2d = to2d(context, p3d)
+    if p2d is None:
+        return None
+    return p3d, tuple(p2d)
+
+def circle_lines(centers, radius, segments = 12): # vertices and LINES indices of circle outlines around centers
+    angles = np.linspace(0, 2 * np.pi, segments, endpoint = False)
+    ring = np.stack((np.cos(angles), np.sin(angles)), axis = 1) * radius
+    verts = (np.asarray(centers, dtype = np.float32).reshape(-1, 1, 2) + ring).reshape(-1, 2)
+    i = np.arange(segments)
+    edges = np.stack((i, (i + 1) % segments), axis = 1)
+    indices = (np.arange(len(verts) // segments)[:, None, None] * segments + edges).reshape(-1, 2)
+    return verts.astype(np.float32), indices.astype(np.int32)
 
 def draw_callback_px(self, context): # callback to draw polygon real time
     radius = 10
@@ -68,33 +195,50 @@ def draw_callback_px(self, context): # callback to draw polygon real time
 
     gpu.state.line_width_set(lw)
     
-    pt = []
-    
     if len(self.mouse_path) == 0:
         return
     
-    for p in self.mouse_path:
-        pt.append(to2d(context, p))
+    shader = gpu.shader.from_builtin('UNIFORM_COLOR')
+    path = self._path
+    
+    if len(path) != len(self.mouse_path):
+        path.set_points(self.mouse_path)
         
-    if self.mouse_pos:
-        pt.append(self.mouse_pos)
+    if path.update(context.region, context.space_data.region_3d):
+        # the placed vertices only change with the view or when one is added
+        xy = path.xy.astype(np.float32)
+        edges = np.stack((np.arange(len(xy) - 1, dtype = np.int32), np.arange(1, len(xy), dtype = np.int32)), axis = 1)
+        edges = edges[path.visible[edges].all(axis = 1)]
+        self._pathBatch = batch_for_shader(shader, 'LINES', {"pos": xy}, indices = edges) if len(edges) else None
+        verts, indices = circle_lines(xy[path.visible], 2)
+        self._markerBatch = batch_for_shader(shader, 'LINES', {"pos": verts}, indices = indices) if len(indices) else None
     
-    shader = gpu.shader.from_builtin('UNIFORM_COLOR')
     gpu.state.blend_set('ALPHA')
     gpu.state.line_width_set(2.0)
-    batch = batch_for_shader(shader, 'LINE_STRIP', {"pos": pt})
     shader.uniform_float("color", (0.0, 0.0, 0.0, 0.5))
-    batch.draw(shader)
     
-    for p in self.mouse_path:
-        draw_circle_2d(to2d(context, p), (0.3, 0.3, 0.3, 1), 2)
+    if self._pathBatch:
+        self._pathBatch.draw(shader)
+        
+    if self.mouse_pos and path.visible[-1]:
+        batch = batch_for_shader(shader, 'LINES', {"pos": [tuple(path.xy[-1]), self.mouse_pos]})
+        batch.draw(shader)
+    
+    if self._markerBatch:
+        shader.uniform_float("color", (0.3, 0.3, 0.3, 1))
+        self._markerBatch.draw(shader)
+
+    gpu.state.line_width_set(lw)
+    gpu.state.blend_set('NONE')
 
 
 class snapigonOperator(bpy.types.Operator):
     """Draw polygon with snapping to nearby points of other strokes.
 Left click to draw polygon. SPACE/ENTER/MIDDLEMOUSE to add as new stroke.
 SHIFT to disable snapping.
+ALT to snap to stroke crossings and edges instead of points.
 CTRL to restrict to horizontal/vertical lines.
+L to snap to visible/active/selected layers, E to end points only, N to neighbor keyframes too.
 Right click/ESC to finish.
 
 Brush color is used as the FILL color, secondary_color is used as the STROKE color.
@@ -104,13 +248,25 @@ Brush color is used as the FILL color, secondary_color is used as the STROKE col
     bl_label = "Snapigon"
     bl_options = {'REGISTER', 'UNDO' }
     
+    layers : EnumProperty(name = "Layers", items = [('VISIBLE', 'Visible', "Snap to all visible layers"),
+                                                  ('ACTIVE', 'Active', "Snap to the active layer only"),
+                                                  ('SELECTED', 'Selected', "Snap to the selected layers and the active layer")],
+                                                  default = 'VISIBLE')
+    endpoints : BoolProperty(name = "End Points Only", description = "Snap to the first and last points of strokes only", default = False)
+    neighbors : BoolProperty(name = "Neighbor Frames", description = "Also snap to the previous and next keyframes of each layer", default = False)
+    
     @classmethod
     def poll(self, context):
         return (context.mode == 'PAINT_GPENCIL')
     
+    def filters(self):
+        return (self.layers, self.endpoints, self.neighbors)
+    
+    def show_filters(self, context):
+        context.area.header_text_set("Snapigon - Layers: %s (L)   End points only: %s (E)   Neighbor frames: %s (N)" %
+            (self.layers.title(), "On" if self.endpoints else "Off", "On" if self.neighbors else "Off"))
+    
     def modal(self, context, event):
-        global startend_points
-        
         if event.type == 'MIDDLEMOUSE' and event.shift:
             self.mouse_pos = None
             return {'PASS_THROUGH'}
@@ -147,16 +303,13 @@ Brush color is used as the FILL color, secondary_color is used as the STROKE col
             if self.close:
                 context.window.cursor_modal_set("DOT")
             else:
-                for p in startend_points:
-                    p3d = (p.co[0], p.co[1], p.co[2])
-                    p2d = to2d(context, p3d)
-                    delta = Vector(self.mouse_pos) - Vector(p2d)
-                    
-                    if delta.length < self.pixels:
-                        self.selectedPoint = p3d
-                        self.drawPoint = p2d
-                        context.window.cursor_modal_set("PAINT_CROSS")
-                        break
+                if event.alt:
+                    snap = find_edge_point(context, self.mouse_pos, self.pixels, self.filters())
+                else:
+                    snap = find_snap_point(context, self.mouse_pos, self.pixels, self.filters())
+                if snap:
+                    self.selectedPoint, self.drawPoint = snap
+                    context.window.cursor_modal_set("PAINT_CROSS")
                     
                 if self.selectedPoint == None:
                     context.window.cursor_modal_set("CROSSHAIR")
@@ -172,12 +325,24 @@ Brush color is used as the FILL color, secondary_color is used as the STROKE col
                     pos = to3d(context, self.mouse_pos)
                     self.mouse_path.append(pos)
             
+        elif event.type in {'L', 'E', 'N'} and event.value == 'PRESS':
+            if event.type == 'L':
+                order = ['VISIBLE', 'ACTIVE', 'SELECTED']
+                self.layers = order[(order.index(self.layers) + 1) % len(order)]
+            elif event.type == 'E':
+                self.endpoints = not self.endpoints
+            else:
+                self.neighbors = not self.neighbors
+            init_startendpoints(context, self.filters())
+            self.show_filters(context)
+            
         elif event.type in {'SPACE', 'ENTER', 'MIDDLEMOUSE'} and event.value == 'RELEASE':
             self.xyz(context)        
             return {'RUNNING_MODAL'}
 
         elif event.type in {'RIGHTMOUSE', 'ESC'}:
             context.window.cursor_modal_restore()
+            context.area.header_text_set(None)
             bpy.types.SpaceView3D.draw_handler_remove(self._handle, 'WINDOW')
             context.area.tag_redraw()
             return {'FINISHED'}
@@ -185,18 +350,16 @@ Brush color is used as the FILL color, secondary_color is used as the STROKE col
         return {'RUNNING_MODAL'}
     
     def xyz(self, context):
-        global startend_points
-        
         C = context
 
         matIndex = C.active_object.active_material_index
         lineWidth = C.tool_settings.gpencil_paint.brush.size
 
         clr = C.tool_settings.gpencil_paint.brush.secondary_color
-        vertexColor = (s2lin(clr.r), s2lin(clr.g), s2lin(clr.b), 1)
+        vertexColor = srgb_to_linear_rgba(clr)
         
         clr = C.tool_settings.gpencil_paint.brush.color 
-        fillColor = (s2lin(clr.r), s2lin(clr.g), s2lin(clr.b), 1)
+        fillColor = srgb_to_linear_rgba(clr)
         
         gp = C.active_object
         layer = gp.data.layers[gp.data.layers.active_index]
@@ -207,15 +370,32 @@ Brush color is used as the FILL color, secondary_color is used as the STROKE col
                 newStroke.line_width = lineWidth
                 newStroke.material_index = matIndex
                 newStroke.vertex_color_fill = fillColor                        
-                newStroke.points.add( len(self.mouse_path) )
-                for idx, pt in enumerate(self.mouse_path):
-                    newStroke.points[idx].co = pt
-                    newStroke.points[idx].vertex_color = vertexColor
+                count = len(self.mouse_path)
+                newStroke.points.add( count )
+                newStroke.points.foreach_set('co', np.asarray(self.mouse_path, dtype=np.float32).ravel())
+                newStroke.points.foreach_set('vertex_color', np.tile(np.asarray(vertexColor, dtype=np.float32), count))
                 newStroke.use_cyclic = self.close
                 newStroke.uv_scale = 1
 
-        init_startendpoints(context)
+                if count > 0:
+                    # file the new points instead of reading all candidates again
+                    sdx = len(frame.strokes) - 1
+                    ldx = gp.data.layers.active_index
+                    entry = snap_frames.get(FrameCache.key(gp, layer, frame))
+                    if entry:
+                        entry.add_stroke(sdx, self.mouse_path, self.close)
+                    if snap_source is not None and (ldx, layer.info, frame.frame_number) in snap_source[1]:
+                        ids = np.zeros((count, 3), dtype=np.int32)
+                        ids[:, 0] = ldx
+                        ids[:, 1] = sdx
+                        ids[:, 2] = np.arange(count)
+                        keep = [0, count - 1] if self.endpoints else slice(None)
+                        startend_points.append(np.asarray(self.mouse_path)[keep], ids[keep])
+                        snap_segments.append_stroke(self.mouse_path, self.close)
+                    snap_frames.own_edit = True
+
         self.mouse_path.clear()
+        self._path.set_points(None)
         self.selectedPoint = None
         self.drawPoint = None
         self.close = False
@@ -229,13 +409,17 @@ Brush color is used as the FILL color, secondary_color is used as the STROKE col
         self.mouse_path.clear()
         self.pixels = 8
         self.close = False
+        self._path = ProjectedPoints()
+        self._pathBatch = None
+        self._markerBatch = None
 
-        init_startendpoints(context)
+        init_startendpoints(context, self.filters())
 
         if context.area.type == 'VIEW_3D':
             self._handle = bpy.types.SpaceView3D.draw_handler_add(draw_callback_px, (self, context), 'WINDOW', 'POST_PIXEL')                    
             context.window_manager.modal_handler_add(self)
             context.window.cursor_modal_set("CROSSHAIR")
+            self.show_filters(context)
             return {'RUNNING_MODAL'}
         else:
             self.report({'WARNING'}, "View3D not found, cannot run operator")
@@ -261,10 +445,12 @@ _classes = [
 def register():
     for cls in _classes:
         bpy.utils.register_class(cls)
+    snap_frames.register()
     
 def unregister():
     for cls in _classes:
         bpy.utils.unregister_class(cls)
+    snap_frames.unregister()
         
 if __name__ == "__main__":
     register()
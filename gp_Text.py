@@ -11,87 +11,92 @@ bl_info = {
 }
 
 import os
+import re
+import csv
 import bpy
 import blf
 import gpu
-import json
+import numpy as np
 from gpu_extras.batch import batch_for_shader
-from bpy_extras import view3d_utils
+from bpy_extras.io_utils import ImportHelper
+# helper modules shared by the add-ons, install them as add-on files next to this one
+try:
+    from gp_TextFont import load_font, find_fonts, stroke_segments, TextLayout
+    from gp_Color import srgb_to_linear_rgba
+except ImportError as e:
+    raise ImportError("gp_Text.py needs gp_TextFont.py and gp_Color.py installed next to it: %s" % e) from e
 
-inputData = None
+_font_items = []
 
-def draw_callback_px(self, context):
-    
-    redraw = False
-
-    if context.scene.gptext_xpos != self._xoff:
-        self._xoff = context.scene.gptext_xpos
-        redraw = True
-    
-    if context.scene.gptext_ypos != self._yoff:
-        self._yoff = context.scene.gptext_ypos
-        redraw = True
+def font_items(self, context): # enumerate stroke fonts in the add-on directory
+    _font_items.clear()
+    for name, path in find_fonts(os.path.dirname(os.path.abspath(__file__))):
+        _font_items.append((path, name, path))
+    return _font_items
 
-    if context.scene.gptext_cx != self._cx:
-        self._cx = context.scene.gptext_cx
-        redraw = True
+def draw_callback_px(self, context):
     
-    if context.scene.gptext_cy != self._cy:
-        self._cy = context.scene.gptext_cy
-        redraw = True
+    scene = context.scene
+    key = (scene.gptext_font, scene.gptext, scene.gptext_xpos, scene.gptext_ypos, scene.gptext_size,
+        scene.gptext_cx, scene.gptext_cy, scene.align, scene.gptext_full_detail)
 
-    if context.scene.gptext_size != self._size:
-        self._size = context.scene.gptext_size
-        redraw = True
+    if key != self._key:
+        self._key = key
+        self.buildString(context)
+        self._batch = None
 
-    if context.scene.align != self._align:
-        self._align = context.scene.align
-        redraw = True
+    if len(self._points) == 0:
+        return
 
-    if context.scene.gptext != self._text:
-        self._text = context.scene.gptext
-        redraw = True
+    shader = gpu.shader.from_builtin('UNIFORM_COLOR')
 
-    if redraw == True:
-        self._strokes = self.buildString(context)
-        redraw = False
-        
-    area = context.area
-    space = area.spaces[0]
-    
-    for region in area.regions:
-        if region.type == 'WINDOW':
-            break
+    if self._batch is None:
+        # one batch of 3D line segments, the GPU projects it for every view
+        coords = np.zeros((len(self._points), 3), dtype=np.float32)
+        coords[:, 0] = self._points[:, 0]
+        coords[:, 2] = self._points[:, 1]
+        self._batch = batch_for_shader(shader, 'LINES', {"pos": coords},
+            indices=stroke_segments(self._lengths))
 
-    shader = gpu.shader.from_builtin('UNIFORM_COLOR')
     gpu.state.blend_set('ALPHA')
 
     lineWidth = int(context.scene.gptext_thickness / 7)
     gpu.state.line_width_set( lineWidth )
     
     clr = context.tool_settings.gpencil_paint.brush.color
-    clr = (s2lin(clr.r), s2lin(clr.g), s2lin(clr.b), 1)
+    clr = srgb_to_linear_rgba(clr)
     shader.uniform_float("color", clr)
 
-    for stroke in self._strokes:
-        stroke2d = []
-        for point in stroke:
-            p = view3d_utils.location_3d_to_region_2d(region, space.region_3d, (point[0],0,point[1]))
-            stroke2d.append(p)
-        batch = batch_for_shader(shader, 'LINE_STRIP', {"pos": stroke2d})
-        batch.draw(shader)    
+    self._batch.draw(shader)
         
     # restore opengl defaults
     gpu.state.line_width_set(1.0)
     gpu.state.blend_set('NONE')
         
-def s2lin(x): # convert srgb to linear
-    a = 0.055
-    if x <= 0.04045:
-        y = x * (1.0 /12.92)
-    else:
-        y = pow ( (x + a) * (1.0 / (1 + a)), 2.4)
-    return y
+def commit_strokes(frame, points, lengths, lineWidth, matIndex, vertexColor, fillColor):
+    # add laid out strokes to frame, allocating and filling each stroke's points in bulk
+    n = len(points)
+    if n == 0:
+        return
+    co = np.zeros((n, 3), dtype=np.float32)
+    co[:, 0] = points[:, 0]
+    co[:, 2] = points[:, 1]
+    colors = np.tile(np.asarray(vertexColor, dtype=np.float32), (n, 1))
+    ones = np.ones(n, dtype=np.float32)
+
+    start = 0
+    for count in lengths:
+        end = start + count
+        newStroke = frame.strokes.new()
+        newStroke.line_width = lineWidth
+        newStroke.material_index = matIndex
+        newStroke.vertex_color_fill = fillColor
+        newStroke.points.add(count)
+        newStroke.points.foreach_set('co', co[start:end].ravel())
+        newStroke.points.foreach_set('vertex_color', colors[start:end].ravel())
+        newStroke.points.foreach_set('pressure', ones[start:end])
+        newStroke.points.foreach_set('strength', ones[start:end])
+        start = end
 
 class GPTEXT_OT_DrawTextOperator(bpy.types.Operator):
     """
@@ -103,123 +108,38 @@ class GPTEXT_OT_DrawTextOperator(bpy.types.Operator):
     _handle = None
     _last_text_drawn = ""
     
-    _cx = 0
-    _cy = 0
-    _xoff = 0
-    _yoff = 0
-    _size = 0
-    _align = 0
-    _text = ""
-
-    def getMinMax(self, ch):
-        ch_min = 999
-        ch_max = -999       
-        
-        data = charData.get(ch)
-
-        if data == None:
-            return ch_min, ch_max
+    _key = None
+    _fontFile = None
+    _layout = None
+    _batch = None
 
-        for ss in data:
-            if len(ss) < 2:
-                continue
-            if isinstance(ss[0], float):
-                ch_min = min(ch_min, ss[0])
-                ch_max = max(ch_max, ss[0])
-            else:
-                for pp in ss:
-                    ch_min = min(ch_min, pp[0])
-                    ch_max = max(ch_max, pp[0])
-                
-        return ch_min, ch_max
-
-    def getStringWidth(self, string, spacing, defaultWidth):
-        width = 0
-        for ch in string:
-            ch_min, ch_max = self.getMinMax(ch)
-            if ch_max != -999:
-                if width > 0: width += spacing
-                width += abs(ch_max - ch_min)
-            else:
-                width += defaultWidth - spacing
-                
-        return width
-    
     def buildString(self, context):
-        
-        stringStrokes = []
-        
-        xoff = context.scene.gptext_xpos
-        yoff = context.scene.gptext_ypos
-        scale = context.scene.gptext_size * 0.1
-        spacing = context.scene.gptext_cx
-        defaultWidth = 1.7
-        
-        lines = context.scene.gptext.split("\\n")
-
-        for string in lines:
-            xoff = context.scene.gptext_xpos
-            stringWidth = self.getStringWidth(string, spacing, defaultWidth)
-
-            if context.scene.align == '1':
-                xoff -= stringWidth / 2 * scale
-            elif context.scene.align == '2':
-                xoff -= stringWidth * scale
-            
-            offset = 0
-            
-            for idx,ch in enumerate(string):
-                ch_min, ch_max = self.getMinMax(ch)
-                if ch_max != -999:
-                    if idx > 0: offset += spacing
-                    strokePoints = []
-                    data = charData.get(ch)
-                    for stroke in data:
-                        if len(stroke) < 2: continue
-                        if isinstance(stroke[0], float):
-                            px = xoff + (stroke[0] + offset - ch_min) * scale
-                            py = yoff + stroke[1] * scale
-                            strokePoints.append( (px, py) )
-                        else:
-                            for point in stroke:
-                                if len(point) == 2:
-                                    px = xoff + (point[0] + offset - ch_min) * scale
-                                    py = yoff + point[1] * scale
-                                    strokePoints.append( (px, py) )
-                                    
-                            stringStrokes.append(strokePoints)
-                            strokePoints = []            
-                    if len(strokePoints) > 1:
-                        stringStrokes.append(strokePoints)
-                    offset += abs(ch_max - ch_min)
-                else:
-                    offset += defaultWidth - spacing
-                    
-            yoff -= context.scene.gptext_cy * scale
-                    
-        return stringStrokes
+        scene = context.scene
+        if self._fontFile != scene.gptext_font:
+            self._fontFile = scene.gptext_font
+            self._layout = TextLayout(load_font(self._fontFile))
+        self._points, self._lengths = self._layout.build(scene.gptext, scene.gptext_xpos, scene.gptext_ypos,
+            scene.gptext_size, scene.gptext_cx, scene.gptext_cy, scene.align, scene.gptext_full_detail)
     
     def invoke(self, context, event):
-        global charData
         
-        # I will eventually enumerate json stroke files in script directory to allow picking
-        jsonFile = os.path.join(bpy.utils.script_path_user(), 'addons', 'comical_gptext.json')
-        if not os.path.exists(jsonFile):
-            print("Missing: " + jsonFile)
+        fontFile = context.scene.gptext_font
+        if not fontFile or not os.path.exists(fontFile):
+            self.report({'ERROR'}, "No stroke font found in " + os.path.dirname(os.path.abspath(__file__)))
             return {'CANCELLED'}
         
-        inputData = open(jsonFile, "rt")
-        
-        charData = json.load(inputData)
-        self._strokes = self.buildString(context)
+        self.buildString(context)
         context.area.tag_redraw()
         x = context.area.x + int(context.area.width / 2)
         y = context.area.y
         context.window.cursor_warp(x,y + 120);
-        self._handle = bpy.types.SpaceView3D.draw_handler_add(draw_callback_px, (self, context), 'WINDOW', 'POST_PIXEL')
+        self._handle = bpy.types.SpaceView3D.draw_handler_add(draw_callback_px, (self, context), 'WINDOW', 'POST_VIEW')
         return context.window_manager.invoke_props_dialog(self)
 
     def draw(self, context):
+        row = self.layout.row()
+        row.prop(context.scene, 'gptext_font')
+        row.prop(context.scene, 'gptext_full_detail')
         row = self.layout.row()
         row.prop(context.scene, 'gptext_xpos')
         row.prop(context.scene, 'gptext_ypos')
@@ -247,7 +167,8 @@ class GPTEXT_OT_DrawTextOperator(bpy.types.Operator):
             self._handle = None
             
         matIndex = 0
-        vertexColor = context.tool_settings.gpencil_paint.brush.color
+        clr = context.tool_settings.gpencil_paint.brush.color
+        vertexColor = srgb_to_linear_rgba(clr)
         fillColor = (1,0,0,1)
         lineWidth = int(context.scene.gptext_thickness)
         
@@ -263,27 +184,125 @@ class GPTEXT_OT_DrawTextOperator(bpy.types.Operator):
             self.report({'ERROR'}, "No keyframe added at current frame")
             return {'FINISHED'}        
             
-        for stroke in self._strokes:
-            newStroke = frame.strokes.new()
-            newStroke.line_width = lineWidth
-            newStroke.material_index = matIndex
-            newStroke.vertex_color_fill = fillColor
-            for point in stroke:
-                newStroke.points.add( 1 )
-                newStroke.points[-1].co = ( point[0], 0, point[1] )
-                newStroke.points[-1].vertex_color = (s2lin(vertexColor.r),
-                    s2lin(vertexColor.g), s2lin(vertexColor.b), 1)
+        commit_strokes(frame, self._points, self._lengths, lineWidth, matIndex, vertexColor, fillColor)
                     
         #self.report({'INFO'}, "Done")
         return {'FINISHED'}        
 
 
+_align_names = { 'left' : '0', 'center' : '1', 'centre' : '1', 'right' : '2' }
+_srt_time = re.compile(r"(\d+):(\d+):(\d+)[,.](\d+)\s*-->\s*(\d+):(\d+):(\d+)[,.](\d+)")
+
+def read_text_rows(path, fps, frameStart, defaults):
+    """Yield (frame, endFrame, text, x, y, size, align) rows from a .srt or .csv file, one at a time.
+
+    Csv rows are frame,text[,x,y,size,align] with an optional header; missing or empty
+    columns take their value from defaults, a (x, y, size, align) tuple. Subtitles start and
+    end on the frames of their timestamps and use the defaults for everything else."""
+    x, y, size, align = defaults
+
+    with open(path, "rt", encoding="utf-8-sig", newline="") as f:
+        if path.lower().endswith('.srt'):
+            start = end = None
+            lines = []
+            for line in f:
+                line = line.strip()
+                match = _srt_time.match(line)
+                if match:
+                    t = [int(v) for v in match.groups()]
+                    start = frameStart + round((t[0] * 3600 + t[1] * 60 + t[2] + t[3] / 1000) * fps)
+                    end = frameStart + round((t[4] * 3600 + t[5] * 60 + t[6] + t[7] / 1000) * fps)
+                elif line:
+                    if start is not None:
+                        lines.append(line)
+                else:
+                    if start is not None and lines:
+                        yield start, end, "\\n".join(lines), x, y, size, align
+                    start = None
+                    lines = []
+            if start is not None and lines:
+                yield start, end, "\\n".join(lines), x, y, size, align
+            return
+
+        for row in csv.reader(f):
+            if len(row) < 2:
+                continue
+            try:
+                frame = int(row[0])
+            except ValueError:
+                continue # header or comment
+            row = row + [''] * (6 - len(row))
+            rowAlign = row[5].strip().lower()
+            yield (frame, None, row[1].replace("\n", "\\n"),
+                float(row[2]) if row[2].strip() else x,
+                float(row[3]) if row[3].strip() else y,
+                float(row[4]) if row[4].strip() else size,
+                _align_names.get(rowAlign, rowAlign) if rowAlign else align)
+
+
+class GPTEXT_OT_BatchTextOperator(bpy.types.Operator, ImportHelper):
+    """Stamp text strokes from a subtitle (.srt) or csv file of frame,text,x,y,size,align rows
+onto the active layer, adding keyframes as needed"""
+    bl_label = "Add text strokes from file"
+    bl_idname = "object.drawtext_batch_operator"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    filter_glob : bpy.props.StringProperty(default="*.srt;*.csv;*.txt", options={'HIDDEN'})
+
+    @classmethod
+    def poll(self, context):
+        return context.active_object is not None and context.active_object.type == 'GPENCIL'
+
+    def execute(self, context):
+        scene = context.scene
+        if not scene.gptext_font or not os.path.exists(scene.gptext_font):
+            self.report({'ERROR'}, "No stroke font found in " + os.path.dirname(os.path.abspath(__file__)))
+            return {'CANCELLED'}
+
+        clr = context.tool_settings.gpencil_paint.brush.color
+        vertexColor = srgb_to_linear_rgba(clr)
+        fillColor = (1,0,0,1)
+        lineWidth = int(scene.gptext_thickness)
+
+        layer = context.active_object.data.layers.active
+        if layer is None:
+            self.report({'ERROR'}, "No active layer")
+            return {'CANCELLED'}
+        frames = { fr.frame_number : fr for fr in layer.frames }
+
+        def keyframe(number):
+            frame = frames.get(number)
+            if frame is None:
+                frame = frames[number] = layer.frames.new(number)
+            return frame
+
+        layout = TextLayout(load_font(scene.gptext_font))
+        defaults = (scene.gptext_xpos, scene.gptext_ypos, scene.gptext_size, scene.align)
+        fps = scene.render.fps / scene.render.fps_base
+
+        count = 0
+        try:
+            for frame, endFrame, text, x, y, size, align in read_text_rows(self.filepath, fps, scene.frame_start, defaults):
+                points, lengths = layout.build(text, x, y, size, scene.gptext_cx, scene.gptext_cy, align, scene.gptext_full_detail)
+                commit_strokes(keyframe(frame), points, lengths, lineWidth, 0, vertexColor, fillColor)
+                if endFrame is not None and endFrame > frame:
+                    keyframe(endFrame) # blank keyframe clears the subtitle
+                count += 1
+        except (OSError, ValueError) as e:
+            self.report({'ERROR'}, "%s (after %d rows)" % (e, count))
+            return {'FINISHED'} if count else {'CANCELLED'}
+
+        self.report({'INFO'}, "Stamped %d rows" % count)
+        return {'FINISHED'}
+
 
 classes = [
-    GPTEXT_OT_DrawTextOperator
+    GPTEXT_OT_DrawTextOperator,
+    GPTEXT_OT_BatchTextOperator
 ]
 
 def register():
+    bpy.types.Scene.gptext_font = bpy.props.EnumProperty( name="Font", description="Stroke font", items=font_items)
     bpy.types.Scene.gptext = bpy.props.StringProperty ( name = "", description = "User text",  default = "Lorem ipsum dolor sit amet,\\nconsectetur adipiscing elit" )
     bpy.types.Scene.gptext_xpos = bpy.props.FloatProperty( name="X", description="X position", default=0.0)
     bpy.types.Scene.gptext_ypos = bpy.props.FloatProperty( name="Y", description="Y position", default=0.0)
@@ -293,6 +312,7 @@ def register():
 
     bpy.types.Scene.gptext_size = bpy.props.FloatProperty( name="Size", description="Size", default=1)
     bpy.types.Scene.gptext_thickness = bpy.props.IntProperty( name="Thickness", description="Thickness", default=40)
+    bpy.types.Scene.gptext_full_detail = bpy.props.BoolProperty( name="Full Detail", description="Stamp every point of the font instead of simplifying glyphs for the text size", default=False)
 
     enum_items = (('0','','','ANCHOR_LEFT',0),('1','','','ANCHOR_CENTER',1),('2','','','ANCHOR_RIGHT',2))
     bpy.types.Scene.align = bpy.props.EnumProperty(items = enum_items, default=1)
@@ -304,5 +324,31 @@ def unregister():
     for cls in reversed(classes):
         bpy.utils.unregister_class(cls)
 
+def benchmark(path, text, repeat = 5):
+    # headless timing of the stroke commit: blender -b --python gp_Text.py -- --benchmark
+    import time
+
+    font = load_font(path)
+    points, lengths = TextLayout(font).build(text, 0, 0, 1, 1, 5, '0')
+
+    gpd = bpy.data.grease_pencils.new("gptext_benchmark")
+    frame = gpd.layers.new("bench").frames.new(1)
+
+    best = None
+    for _ in range(repeat):
+        frame.clear()
+        t = time.perf_counter()
+        commit_strokes(frame, points, lengths, 40, 0, (0, 0, 0, 1), (1, 0, 0, 1))
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+
+    bpy.data.grease_pencils.remove(gpd)
+    print("%d chars, %d strokes, %d points: %.2f ms" % (len(text), len(lengths), len(points), best * 1000))
+
 if __name__ == "__main__":
-    register()
\ No newline at end of file
+    import sys
+    if "--benchmark" in sys.argv:
+        benchmark(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'comical_gptext.json'),
+            "The quick brown fox jumps over the lazy dog. " * 10)
+    else:
+        register()
\ No newline at end of file
@@ -0,0 +1,424 @@
+import os
+import json
+import mmap
+import numpy as np
+
+# Stroke font loading and line layout for gp_Text.
+#
+# A font file maps characters to a list of strokes, each stroke a list of (x, y) points.
+# Glyphs are compiled once into flat point arrays with their metrics precomputed, so laying
+# out a line is a table lookup per character plus one array translation per glyph.
+#
+# Json fonts are compiled on first use into a .gpfont file next to them:
+#
+#   header       magic, glyph count, stroke count, point count
+#   glyph index  codepoint, min, max, first stroke, stroke count, first point, point count
+#   strokes      uint32 point count of every stroke
+#   points       float32 x, y of every point, x shifted so each glyph starts at 0
+#
+# A .gpfont is memory-mapped and only the glyphs a text actually uses are read from it.
+
+DEFAULT_WIDTH = 1.7 # advance used for characters missing from the font
+
+FONT_MAGIC = b'GPFONT01'
+FONT_SUFFIX = '.gpfont'
+JSON_SUFFIX = '_gptext.json'
+
+HEADER_DTYPE = np.dtype([('magic', 'S8'), ('glyphs', '<u4'), ('strokes', '<u4'), ('points', '<u4')])
+GLYPH_DTYPE = np.dtype([('code', '<u4'), ('min', '<f4'), ('max', '<f4'),
+    ('stroke', '<u4'), ('strokes', '<u4'), ('point', '<u4'), ('points', '<u4')])
+
+# Ramer-Douglas-Peucker tolerances, in glyph units, of the detail levels kept for each glyph.
+# Level 0 is the glyph as drawn.
+LOD_TOLERANCES = (0.0, 0.01, 0.02, 0.04, 0.08)
+LOD_WORLD_TOLERANCE = 0.002 # largest deviation allowed in the stamped strokes, in blender units
+
+_fonts = {}
+
+def simplify_stroke(points, tolerance):
+    """Return the indices of the points of a stroke kept by Ramer-Douglas-Peucker decimation."""
+    n = len(points)
+    if n < 3 or tolerance <= 0:
+        return np.arange(n)
+
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        a = points[first]
+        d = points[last] - a
+        rel = points[first + 1:last] - a
+        length = np.hypot(d[0], d[1])
+        if length > 0:
+            dist = np.abs(d[0] * rel[:, 1] - d[1] * rel[:, 0]) / length
+        else:
+            dist = np.hypot(rel[:, 0], rel[:, 1])
+        i = int(np.argmax(dist))
+        if dist[i] > tolerance:
+            mid = first + 1 + i
+            keep[mid] = True
+            stack.append((first, mid))
+            stack.append((mid, last))
+
+    return np.flatnonzero(keep)
+
+
+def lod_level(scale, worldTolerance = LOD_WORLD_TOLERANCE):
+    """Return the coarsest detail level whose error at scale stays within worldTolerance."""
+    level = 0
+    for i, tolerance in enumerate(LOD_TOLERANCES):
+        if tolerance * scale <= worldTolerance:
+            level = i
+    return level
+
+
+class Glyph:
+    __slots__ = ('min', 'max', 'width', 'points', 'lengths', 'levels')
+
+    def __init__(self, ch_min, ch_max, points, lengths):
+        self.min = ch_min
+        self.max = ch_max
+        self.width = abs(ch_max - ch_min)
+        self.points = points # (N, 2) float array, x shifted so the glyph starts at 0
+        self.lengths = lengths # number of points of each stroke in points
+        self.levels = [(points, lengths)]
+
+        for tolerance in LOD_TOLERANCES[1:]:
+            parts = []
+            levelLengths = []
+            start = 0
+            for count in lengths:
+                stroke = points[start:start + count]
+                stroke = stroke[simplify_stroke(stroke, tolerance)]
+                parts.append(stroke)
+                levelLengths.append(len(stroke))
+                start += count
+            levelPoints = np.concatenate(parts) if parts else points
+            self.levels.append((levelPoints, levelLengths))
+
+
+class StrokeFont:
+    def __init__(self, path, mtime, glyphs):
+        self.path = path
+        self.mtime = mtime
+        self.glyphs = glyphs
+
+    def get(self, ch):
+        return self.glyphs.get(ch)
+
+    def close(self):
+        pass
+
+
+class MappedStrokeFont(StrokeFont):
+    """A compiled .gpfont, read lazily one glyph at a time from a memory map."""
+
+    def __init__(self, path, mtime):
+        super().__init__(path, mtime, {})
+
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = np.frombuffer(self._map, HEADER_DTYPE, 1).copy()[0]
+        if header['magic'] != FONT_MAGIC:
+            self.close()
+            raise ValueError("Not a stroke font: " + path)
+
+        offset = HEADER_DTYPE.itemsize
+        index = np.frombuffer(self._map, GLYPH_DTYPE, int(header['glyphs']), offset)
+        offset += index.nbytes
+        self._lengths = np.frombuffer(self._map, '<u4', int(header['strokes']), offset).copy()
+        offset += self._lengths.nbytes
+        self._points = offset
+
+        self._index = { chr(g['code']) : g for g in index.copy() }
+
+    def get(self, ch):
+        glyph = self.glyphs.get(ch)
+        if glyph is None:
+            entry = self._index.get(ch)
+            if entry is None:
+                return None
+            points = np.frombuffer(self._map, '<f4', int(entry['points']) * 2,
+                self._points + int(entry['point']) * 8).reshape(-1, 2).astype(np.float64)
+            first = int(entry['stroke'])
+            lengths = self._lengths[first:first + int(entry['strokes'])].tolist()
+            glyph = Glyph(float(entry['min']), float(entry['max']), points, lengths)
+            self.glyphs[ch] = glyph
+        return glyph
+
+    def close(self):
+        if self._map:
+            self._map.close()
+            self._map = None
+
+
+def compile_glyph(data):
+    # mirrors the original json reader: a bare [x, y] pair is collected into the next stroke
+    ch_min = 999
+    ch_max = -999
+
+    strokes = []
+    pending = []
+    for ss in data:
+        if len(ss) < 2:
+            continue
+        if isinstance(ss[0], float):
+            ch_min = min(ch_min, ss[0])
+            ch_max = max(ch_max, ss[0])
+            pending.append((ss[0], ss[1]))
+        else:
+            for pp in ss:
+                ch_min = min(ch_min, pp[0])
+                ch_max = max(ch_max, pp[0])
+                if len(pp) == 2:
+                    pending.append((pp[0], pp[1]))
+            strokes.append(pending)
+            pending = []
+    if len(pending) > 1:
+        strokes.append(pending)
+
+    if ch_max == -999:
+        return None
+
+    lengths = [len(s) for s in strokes]
+    points = np.array([p for s in strokes for p in s], dtype=np.float64).reshape(-1, 2)
+    points[:, 0] -= ch_min
+
+    return Glyph(ch_min, ch_max, points, lengths)
+
+
+def read_json_font(path):
+    with open(path, "rt") as f:
+        data = json.load(f)
+
+    glyphs = {}
+    for ch, strokes in data.items():
+        glyph = compile_glyph(strokes)
+        if glyph:
+            glyphs[ch] = glyph
+    return glyphs
+
+
+def compile_font(path, outPath):
+    """Compile the json stroke font at path into a .gpfont file at outPath."""
+    glyphs = [(ch, g) for ch, g in sorted(read_json_font(path).items()) if len(ch) == 1]
+
+    index = np.zeros(len(glyphs), GLYPH_DTYPE)
+    lengths = []
+    points = []
+    pointCount = 0
+    for i, (ch, g) in enumerate(glyphs):
+        index[i] = (ord(ch), g.min, g.max, len(lengths), len(g.lengths), pointCount, len(g.points))
+        lengths.extend(g.lengths)
+        points.append(g.points)
+        pointCount += len(g.points)
+
+    header = np.array([(FONT_MAGIC, len(glyphs), len(lengths), pointCount)], HEADER_DTYPE)
+    points = np.concatenate(points) if points else np.zeros((0, 2))
+
+    # write beside the target and swap in, so a mapped older version is never truncated
+    tmpPath = outPath + ".tmp"
+    with open(tmpPath, "wb") as f:
+        f.write(header.tobytes())
+        f.write(index.tobytes())
+        f.write(np.asarray(lengths, '<u4').tobytes())
+        f.write(points.astype('<f4').tobytes())
+    os.replace(tmpPath, outPath)
+
+
+def load_font(path):
+    """Return the compiled font for path, re-reading the file only when its mtime changed.
+
+    A json font is compiled to a .gpfont beside it, falling back to parsing the json
+    when that file cannot be written."""
+    if path.endswith('.json'):
+        compiled = path[:-len('.json')] + FONT_SUFFIX
+        try:
+            if not os.path.exists(compiled) or os.stat(compiled).st_mtime_ns < os.stat(path).st_mtime_ns:
+                stale = _fonts.pop(compiled, None)
+                if stale:
+                    stale.close()
+                compile_font(path, compiled)
+            path = compiled
+        except OSError as e:
+            print("Could not compile %s: %s" % (path, e))
+
+    mtime = os.stat(path).st_mtime_ns
+
+    font = _fonts.get(path)
+    if font and font.mtime == mtime:
+        return font
+    if font:
+        font.close()
+
+    if path.endswith(FONT_SUFFIX):
+        font = MappedStrokeFont(path, mtime)
+    else:
+        font = StrokeFont(path, mtime, read_json_font(path))
+
+    _fonts[path] = font
+    return font
+
+
+def find_fonts(directory):
+    """Return (name, path) of the stroke fonts in directory, json sources before compiled copies."""
+    fonts = {}
+    try:
+        files = sorted(os.listdir(directory))
+    except OSError:
+        return []
+
+    for file in files:
+        if file.endswith(JSON_SUFFIX):
+            fonts[file[:-len(JSON_SUFFIX)]] = os.path.join(directory, file)
+    for file in files:
+        if file.endswith(FONT_SUFFIX):
+            name = file[:-len(FONT_SUFFIX)]
+            if name.endswith('_gptext'):
+                name = name[:-len('_gptext')]
+            fonts.setdefault(name, os.path.join(directory, file))
+
+    return sorted(fonts.items())
+
+
+def string_width(font, string, spacing, defaultWidth = DEFAULT_WIDTH):
+    width = 0
+    for ch in string:
+        glyph = font.get(ch)
+        if glyph:
+            if width > 0: width += spacing
+            width += glyph.width
+        else:
+            width += defaultWidth - spacing
+
+    return width
+
+
+def layout_line(font, string, spacing, defaultWidth = DEFAULT_WIDTH, level = 0):
+    """Lay out one line in glyph units starting at x = 0, using glyph detail level.
+
+    Returns an (N, 2) point array and the point count of each stroke."""
+    parts = []
+    lengths = []
+    offset = 0
+
+    for idx, ch in enumerate(string):
+        glyph = font.get(ch)
+        if glyph:
+            if idx > 0: offset += spacing
+            points, glyphLengths = glyph.levels[level]
+            if len(points):
+                parts.append(points + (offset, 0))
+                lengths.extend(glyphLengths)
+            offset += glyph.width
+        else:
+            offset += defaultWidth - spacing
+
+    if not parts:
+        return np.zeros((0, 2)), lengths
+
+    return np.concatenate(parts), lengths
+
+
+class TextLayout:
+    """Lays out multi-line text, caching each laid out line.
+
+    Lines are cached by (text, size, spacing, align, level) relative to their anchor, so moving
+    the text only translates the cached arrays and editing one line re-lays out only that line.
+    Unless full detail is asked for, glyphs are simplified as far as the text size allows."""
+
+    def __init__(self, font):
+        self.font = font
+        self._lines = {}
+
+    def layout_line(self, string, size, spacing, align, level = 0):
+        key = (string, size, spacing, align, level)
+        line = self._lines.get(key)
+        if line is None:
+            scale = size * 0.1
+            points, lengths = layout_line(self.font, string, spacing, level=level)
+            points = points * scale
+            if align == '1':
+                points[:, 0] -= string_width(self.font, string, spacing) / 2 * scale
+            elif align == '2':
+                points[:, 0] -= string_width(self.font, string, spacing) * scale
+            line = (points, lengths)
+            self._lines[key] = line
+        return key, line
+
+    def build(self, text, xpos, ypos, size, spacing, lineSpacing, align, fullDetail = False):
+        """Return the (N, 2) points and per-stroke point counts of text, split on literal \\n."""
+        parts = []
+        lengths = []
+        used = {}
+        yoff = ypos
+        level = 0 if fullDetail else lod_level(abs(size) * 0.1)
+
+        for string in text.split("\\n"):
+            key, (points, lineLengths) = self.layout_line(string, size, spacing, align, level)
+            used[key] = self._lines[key]
+            if len(points):
+                parts.append(points + (xpos, yoff))
+                lengths.extend(lineLengths)
+            yoff -= lineSpacing * size * 0.1
+
+        # only the lines currently in the text are worth keeping
+        self._lines = used
+
+        if not parts:
+            return np.zeros((0, 2)), lengths
+
+        return np.concatenate(parts), lengths
+
+
+def split_strokes(points, lengths):
+    return np.split(points, np.cumsum(lengths)[:-1]) if lengths else []
+
+
+def stroke_segments(lengths):
+    """Return an (M, 2) array of point index pairs joining consecutive points of each stroke."""
+    count = sum(lengths)
+    if count < 2:
+        return np.zeros((0, 2), dtype=np.int32)
+    # drop the pair that would join the last point of a stroke to the first of the next
+    keep = np.ones(count - 1, dtype=bool)
+    ends = np.cumsum(lengths)[:-1] - 1
+    keep[ends[(ends >= 0) & (ends < count - 1)]] = False
+    start = np.arange(count - 1, dtype=np.int32)[keep]
+    return np.stack((start, start + 1), axis=1)
+
+
+if __name__ == "__main__":
+    # benchmark: python gp_TextFont.py [font.json]
+    import sys
+    import timeit
+
+    path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'comical_gptext.json')
+    text = "Lorem ipsum dolor sit amet, consectetur adipiscing elit " * 4
+
+    # empty strokes join nothing and cut nothing from their neighbours
+    assert stroke_segments([0, 3]).tolist() == [[0, 1], [1, 2]]
+    assert stroke_segments([2, 0, 3]).tolist() == [[0, 1], [2, 3], [3, 4]]
+
+    def reparse():
+        with open(path, "rt") as f:
+            charData = json.load(f)
+        # old behaviour: rescan every stroke of a glyph for its min/max, twice per character
+        for _ in range(2):
+            for ch in text:
+                for ss in charData.get(ch, []):
+                    for pp in ss:
+                        min(pp[0], 999)
+
+    def cached():
+        font = load_font(path)
+        string_width(font, text, 1)
+        layout_line(font, text, 1)
+
+    for name, fn in (('reparse', reparse), ('cached', cached)):
+        t = min(timeit.repeat(fn, number=20, repeat=3)) / 20
+        print("%-8s %8.3f ms per layout" % (name, t * 1000))
@@ -1,71 +1,462 @@
 import bpy
+import time
+import zlib
+import numpy as np
 
-context = bpy.context
-
-gp = context.active_object
-if gp == None or gp.type != 'GPENCIL':
-    exit
-
-NUM_COLOR_ATTRIB_MATERIALS = len(gp.data.materials)
-
-for layer in gp.data.layers:
-    for frame in layer.frames:
-        for stroke in frame.strokes:
-            if len(stroke.points) == 0 : continue
-            mat_index = stroke.material_index
-            vertex_color = vertex_color_fill = None
-            if gp.data.materials[mat_index].grease_pencil.show_fill:
-                vertex_color_fill = stroke.vertex_color_fill
-            if gp.data.materials[mat_index].grease_pencil.show_stroke:
-                vertex_color = stroke.points[0].vertex_color     
-            
-            bFound = False
-            
-            for idx in range(NUM_COLOR_ATTRIB_MATERIALS, len(gp.data.materials)):
-                mat = gp.data.materials[idx].grease_pencil
-                
-                mc = [ mat.color[0], mat.color[1], mat.color[2] ]
-                mf = [ mat.fill_color[0], mat.fill_color[1], mat.fill_color[2] ]
-
-                if vertex_color and not vertex_color_fill:
-                    sc = [ vertex_color[0], vertex_color[1], vertex_color[2] ]
-                    if mat.show_stroke and not mat.show_fill and sc == mc:
-                        stroke.material_index = idx
-                        bFound = True
-                        break
-                        
-                if vertex_color_fill and not vertex_color:
-                    sf = [ vertex_color_fill[0], vertex_color_fill[1], vertex_color_fill[2]]
-                    if mat.show_fill and not mat.show_stroke and sf == mf:
-                        stroke.material_index = idx
-                        bFound = True
-                        break
-                    
-                if vertex_color and vertex_color_fill:
-                    sc = [ vertex_color[0], vertex_color[1], vertex_color[2] ]
-                    sf = [ vertex_color_fill[0], vertex_color_fill[1], vertex_color_fill[2]]
-                    if mat.show_stroke and mat.show_fill and sc == mc and sf == mf:
-                        stroke.material_index = idx
-                        bFound = True
-                        break
-                            
-            if bFound == False:
-                # create new material    
-                gp_mat = bpy.data.materials.new("COLOR" + str( len(gp.data.materials) + 1) )
-
-                if not gp_mat.is_grease_pencil:
-                    bpy.data.materials.create_gpencil_data(gp_mat)
-                    if vertex_color:
-                        gp_mat.grease_pencil.color = (vertex_color[0], vertex_color[1], vertex_color[2], 1)
-                        gp_mat.grease_pencil.show_stroke=True
-                    else:
-                        gp_mat.grease_pencil.show_stroke=False
-                    
-                    if vertex_color_fill:
-                        gp_mat.grease_pencil.fill_color = (vertex_color_fill[0], vertex_color_fill[1], vertex_color_fill[2], 1) 
-                        gp_mat.grease_pencil.show_fill=True
-                    else:
-                        gp_mat.grease_pencil.show_fill=False
-
-                gp.data.materials.append(gp_mat)
-                stroke.material_index = len(gp.data.materials) - 1
\ No newline at end of file
+# Create a material for every distinct stroke/fill vertex color of a grease pencil object
+# and assign strokes to them. Shared by the QuickTools "Create Materials" button and usable
+# as a script: run it from the text editor with a grease pencil object active. Both go
+# through quickCreateMaterialsOperator, which works through the frames a slice at a time.
+
+def cmp(clr1, clr2):
+    delta = 0.03
+    return abs(clr1[0] - clr2[0]) < delta and abs(clr1[1] - clr2[1]) < delta and abs(clr1[2] - clr2[2]) < delta
+
+class MaterialIndex:
+    """Finds the first material matching a stroke's colors within cmp's tolerance.
+
+    Materials are bucketed by their show_stroke/show_fill flags and their color quantized to
+    cells the size of the tolerance, so a lookup only probes the 27 cells around a color."""
+
+    cell = 0.03
+
+    def __init__(self, materials):
+        self._cells = {}
+        self._colors = {}
+        for idx, mat in enumerate(materials):
+            self.add(idx, mat)
+
+    def _cell(self, clr):
+        return (int(clr[0] // self.cell), int(clr[1] // self.cell), int(clr[2] // self.cell))
+
+    def _insert(self, idx, show_stroke, show_fill, mc, mf):
+        self._colors[idx] = (show_stroke, show_fill, mc, mf)
+        key = mc if show_stroke else mf
+        self._cells.setdefault((show_stroke, show_fill, self._cell(key)), []).append(idx)
+
+    def add(self, idx, mat):
+        if mat is None or not mat.is_grease_pencil:
+            return
+        gpm = mat.grease_pencil
+        if not gpm.show_stroke and not gpm.show_fill:
+            return
+        self._insert(idx, gpm.show_stroke, gpm.show_fill, tuple(gpm.color[:3]), tuple(gpm.fill_color[:3]))
+
+    def find(self, vertex_color, vertex_color_fill):
+        show_stroke = vertex_color is not None
+        show_fill = vertex_color_fill is not None
+        key = vertex_color if show_stroke else vertex_color_fill
+        if key is None:
+            return None
+
+        cx, cy, cz = self._cell(key)
+        found = None
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    for idx in self._cells.get((show_stroke, show_fill, (cx + dx, cy + dy, cz + dz)), ()):
+                        if found is not None and idx > found:
+                            continue
+                        mc, mf = self._colors[idx][2:]
+                        if show_stroke and not cmp(vertex_color, mc):
+                            continue
+                        if show_fill and not cmp(vertex_color_fill, mf):
+                            continue
+                        found = idx
+        return found
+
+
+def material_flags(materials):
+    """Return an (N, 2) bool array of show_stroke, show_fill for each material slot."""
+    flags = np.zeros((len(materials), 2), dtype=bool)
+    for idx, mat in enumerate(materials):
+        if mat is not None and mat.is_grease_pencil:
+            flags[idx] = (mat.grease_pencil.show_stroke, mat.grease_pencil.show_fill)
+    return flags
+
+
+def snapshot_frame(frame, flags):
+    """Read the attributes material matching needs for every stroke of frame.
+
+    Returns material_index (S,), vertex_color_fill (S, 4), the first point's vertex_color
+    (S, 4) and the point count (S,) of each stroke."""
+    strokes = frame.strokes
+    count = len(strokes)
+
+    mat = np.zeros(count, dtype=np.int32)
+    fill = np.zeros(count * 4, dtype=np.float32)
+    if count:
+        strokes.foreach_get('material_index', mat)
+        strokes.foreach_get('vertex_color_fill', fill)
+    fill = fill.reshape(-1, 4)
+
+    points = np.fromiter((len(s.points) for s in strokes), dtype=np.int32, count=count)
+
+    # the first point's color has no bulk accessor, read it only where the material shows strokes
+    color = np.zeros((count, 4), dtype=np.float32)
+    show_stroke = np.zeros(count, dtype=bool)
+    valid = mat < len(flags)
+    show_stroke[valid] = flags[mat[valid], 0]
+    for i in np.flatnonzero(show_stroke & (points > 0)):
+        color[i] = strokes[int(i)].points[0].vertex_color
+
+    return mat, fill, color, points
+
+
+def new_material(materials, vertex_color, vertex_color_fill, prefix = "COLOR"):
+    gp_mat = bpy.data.materials.new(prefix + str( len(materials) + 1) )
+
+    if not gp_mat.is_grease_pencil:
+        bpy.data.materials.create_gpencil_data(gp_mat)
+        if vertex_color:
+            gp_mat.grease_pencil.color = (vertex_color[0], vertex_color[1], vertex_color[2], 1)
+            gp_mat.grease_pencil.show_stroke=True
+        else:
+            gp_mat.grease_pencil.show_stroke=False
+        
+        if vertex_color_fill:
+            gp_mat.grease_pencil.fill_color = (vertex_color_fill[0], vertex_color_fill[1], vertex_color_fill[2], 1) 
+            gp_mat.grease_pencil.show_fill=True
+        else:
+            gp_mat.grease_pencil.show_fill=False
+
+    materials.append(gp_mat)
+    return gp_mat
+
+
+def stroke_keys(mat, fill, color, points, flags):
+    """Return the rows of the strokes to match and their color keys.
+
+    A key is show_stroke, show_fill, stroke rgb, fill rgb, with the colors a stroke's material
+    does not show zeroed."""
+    valid = (points > 0) & (mat >= 0) & (mat < len(flags))
+    show = np.zeros((len(mat), 2), dtype=bool)
+    show[valid] = flags[mat[valid]]
+    show_stroke = show[:, 0]
+    show_fill = show[:, 1]
+
+    # skip strokes drawn with material color
+    skip = (show_fill & (fill[:, 3] == 0)) & (show_stroke & (color[:, 3] == 0))
+    rows = np.flatnonzero(valid & (show_stroke | show_fill) & ~skip)
+
+    keys = np.zeros((len(rows), 8), dtype=np.float32)
+    keys[:, 0] = show_stroke[rows]
+    keys[:, 1] = show_fill[rows]
+    keys[:, 2:5] = color[rows, :3] * show_stroke[rows, None]
+    keys[:, 5:8] = fill[rows, :3] * show_fill[rows, None]
+    return rows, keys
+
+
+def create_materials_frame(gp, frame, index, flags, snapshot = None):
+    """Assign the strokes of frame to materials matching their colors, creating missing ones.
+
+    flags is the material_flags() array and grows with new materials, snapshot the frame's
+    snapshot_frame() arrays if already read. Returns the new flags, the number of strokes whose
+    material changed and the snapshot arrays as written back to the frame."""
+    materials = gp.data.materials
+    if snapshot is None:
+        snapshot = snapshot_frame(frame, flags)
+    mat, fill, color, points = snapshot
+    rows, keys = stroke_keys(mat, fill, color, points, flags)
+    if len(rows) == 0:
+        return flags, 0, snapshot
+
+    # strokes with identical colors resolve identically, look each combination up once
+    unique, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+
+    resolved = np.zeros(len(unique), dtype=np.int32)
+    created = []
+    for u in np.argsort(first, kind='stable'):
+        key = unique[u]
+        vertex_color = tuple(key[2:5]) if key[0] else None
+        vertex_color_fill = tuple(key[5:8]) if key[1] else None
+        idx = index.find(vertex_color, vertex_color_fill)
+        if idx is None:
+            gp_mat = new_material(materials, vertex_color, vertex_color_fill)
+            idx = len(materials) - 1
+            index.add(idx, gp_mat)
+            flags = np.vstack((flags, [[bool(key[0]), bool(key[1])]]))
+            created.append(rows[first[u]])
+        resolved[u] = idx
+
+    assigned = resolved[inverse]
+    changed = assigned != mat[rows]
+    if changed.any():
+        mat[rows] = assigned
+        frame.strokes.foreach_set('material_index', mat)
+
+    if created:
+        # the stroke a material was made from shows that material's color from now on
+        fill[created, 3] = 0
+        frame.strokes.foreach_set('vertex_color_fill', fill.ravel())
+
+    # a stroke keeps its kind of material, so the first point colors read still apply
+    return flags, int(changed.sum()), (mat, fill, color, points)
+
+
+# Custom property on the grease pencil data remembering the materials and a fingerprint of
+# every frame already converted, so later runs only look at frames that changed.
+INDEX_PROP = "quicktools_material_index"
+
+def frame_key(layer, frame):
+    # layer names can be longer than a custom property key allows
+    return "%08x/%d" % (zlib.crc32(layer.info.encode()), frame.frame_number)
+
+
+def frame_fingerprint(snapshot):
+    """Return a hash of a frame's snapshot_frame() arrays, covering its stroke count, material
+    indices, fill colors, first point colors and point counts.
+
+    Reading the snapshot is most of the work of a frame, a matching fingerprint saves only
+    the color matching and the writes."""
+    mat = snapshot[0]
+    crc = zlib.crc32(np.int32(len(mat)).tobytes())
+    for values in snapshot:
+        crc = zlib.crc32(np.ascontiguousarray(values).tobytes(), crc)
+    return "%08x" % crc
+
+
+def material_signature(mat):
+    if mat is None or not mat.is_grease_pencil:
+        return mat.name if mat else ""
+    gpm = mat.grease_pencil
+    return "%s %d %d %s %s" % (mat.name, gpm.show_stroke, gpm.show_fill,
+        " ".join("%.6f" % v for v in gpm.color[:3]), " ".join("%.6f" % v for v in gpm.fill_color[:3]))
+
+
+def load_fingerprints(gp):
+    """Return the frame fingerprints stored by the last run.
+
+    They are only trusted while the materials that run saw are still the first slots with the
+    same colors and show flags, materials added since do not change how strokes match."""
+    stored = gp.data.get(INDEX_PROP)
+    if stored is None or not stored.get('materials'):
+        return {}
+    signatures = [material_signature(mat) for mat in gp.data.materials]
+    storedSignatures = stored['materials'].split("\n")
+    if storedSignatures != signatures[:len(storedSignatures)]:
+        return {}
+    return dict(stored.get('frames', {}))
+
+
+def save_fingerprints(gp, fingerprints):
+    gp.data[INDEX_PROP] = {
+        'materials' : "\n".join(material_signature(mat) for mat in gp.data.materials),
+        'frames' : fingerprints,
+    }
+
+
+def iter_create_materials(gp, full = False):
+    """Create materials one frame at a time, yielding (frames done, total frames, strokes changed).
+
+    Frames whose fingerprint matches the last run are skipped unless full is set. Every frame
+    is finished before it yields, so stopping early leaves the object consistent; the fingerprints
+    are saved when the generator ends or is closed."""
+    if gp is None or gp.type != 'GPENCIL':
+        return
+
+    materials = gp.data.materials
+    index = MaterialIndex(materials)
+    fingerprints = {} if full else load_fingerprints(gp)
+    flags = material_flags(materials)
+
+    total = sum(len(layer.frames) for layer in gp.data.layers)
+    done = changed = 0
+    seen = {}
+    try:
+        for layer in gp.data.layers:
+            for frame in layer.frames:
+                key = frame_key(layer, frame)
+                snapshot = snapshot_frame(frame, flags)
+                if fingerprints.get(key) != frame_fingerprint(snapshot):
+                    flags, count, snapshot = create_materials_frame(gp, frame, index, flags, snapshot)
+                    changed += count
+                    fingerprints[key] = frame_fingerprint(snapshot)
+                seen[key] = fingerprints[key]
+                done += 1
+                yield done, total, changed
+        fingerprints = seen # forget frames that no longer exist
+    finally:
+        save_fingerprints(gp, fingerprints)
+
+
+def create_materials_from_strokes(gp, full = False):
+    changed = 0
+    for done, total, changed in iter_create_materials(gp, full):
+        pass
+    return changed
+
+
+class quickCreateMaterialsOperator(bpy.types.Operator):
+    """Create a material for each stroke and fill vertex color, a few frames at a time.
+Only frames changed since the last run are examined, SHIFT-click to examine every frame.
+ESC to stop, frames already done are kept"""
+
+    bl_idname = "quicktools.create_materials"
+    bl_label = "Create Materials"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    time_slice = 0.05 # seconds of work per timer event
+
+    full : bpy.props.BoolProperty(name="All Frames", description="Examine every frame, not only those changed since the last run", default=False, options={'SKIP_SAVE'})
+
+    @classmethod
+    def poll(cls, context):
+        return context.active_object is not None and context.active_object.type == 'GPENCIL'
+
+    def finish(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        if context.area:
+            context.area.header_text_set(None)
+
+    def modal(self, context, event):
+        if event.type in {'ESC', 'RIGHTMOUSE'}:
+            self._work.close()
+            self.finish(context)
+            # keep the frames already converted as one undoable step
+            self.report({'WARNING'}, "Stopped after %d of %d frames, %d strokes changed" % (self._done, self._total, self._changed))
+            return {'FINISHED'}
+
+        if event.type != 'TIMER':
+            return {'RUNNING_MODAL'}
+
+        end = time.perf_counter() + self.time_slice
+        for self._done, self._total, self._changed in self._work:
+            if time.perf_counter() > end:
+                break
+        else:
+            self.finish(context)
+            self.report({'INFO'}, "%d frames, %d strokes changed" % (self._total, self._changed))
+            return {'FINISHED'}
+
+        context.window_manager.progress_update(self._done)
+        if context.area:
+            context.area.header_text_set("Create Materials: frame %d of %d, ESC to stop" % (self._done, self._total))
+        return {'RUNNING_MODAL'}
+
+    def invoke(self, context, event):
+        gp = context.active_object
+        if event.shift:
+            self.full = True
+        self._work = iter_create_materials(gp, self.full)
+        self._done = self._changed = 0
+        self._total = sum(len(layer.frames) for layer in gp.data.layers)
+
+        wm = context.window_manager
+        wm.progress_begin(0, max(1, self._total))
+        self._timer = wm.event_timer_add(0.001, window=context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        changed = create_materials_from_strokes(context.active_object, self.full)
+        self.report({'INFO'}, "%d strokes changed" % changed)
+        return {'FINISHED'}
+
+
+def median_cut(keys, weights, count):
+    """Cluster color keys into at most count boxes by weighted median cut.
+
+    Keys of different kinds (stroke only, fill only, both) are never mixed, so every kind
+    present gets at least one box even when count is smaller. Returns the box label of each
+    key and the weighted mean key of each box."""
+    features = keys.astype(np.float64)
+
+    kinds, kind = np.unique(keys[:, :2], axis=0, return_inverse=True)
+    boxes = [np.flatnonzero(kind.ravel() == k) for k in range(len(kinds))]
+    while len(boxes) < count:
+        spans = [np.ptp(features[b], axis=0).max() if len(b) > 1 else -1 for b in boxes]
+        widest = int(np.argmax(spans))
+        if spans[widest] <= 0:
+            break
+        box = boxes[widest]
+        axis = int(np.argmax(np.ptp(features[box], axis=0)))
+        box = box[np.argsort(features[box, axis], kind='stable')]
+        cumulative = np.cumsum(weights[box])
+        cut = int(np.searchsorted(cumulative, cumulative[-1] / 2))
+        # never separate equal values, keys with the same color on that axis stay together
+        values = features[box, axis]
+        bounds = np.flatnonzero(values[1:] != values[:-1]) + 1
+        cut = int(bounds[np.argmin(np.abs(bounds - cut))])
+        boxes[widest:widest + 1] = [box[:cut], box[cut:]]
+
+    labels = np.zeros(len(keys), dtype=np.int32)
+    palette = np.zeros((len(boxes), keys.shape[1]))
+    for i, box in enumerate(boxes):
+        labels[box] = i
+        palette[i] = np.average(keys[box], axis=0, weights=weights[box])
+    return labels, palette
+
+
+def create_palette_materials(gp, size):
+    """Cluster the stroke and fill colors of every frame into at most size materials, or one
+    for each kind of stroke, fill or both present if there are more kinds than that.
+
+    Palette entries within tolerance of an existing material reuse it. Returns the number of
+    strokes whose material changed and the mean and largest RGB distance between a stroke's
+    colors and its palette entry."""
+    if gp is None or gp.type != 'GPENCIL':
+        return 0, 0.0, 0.0
+
+    materials = gp.data.materials
+    flags = material_flags(materials)
+
+    frames = []
+    allKeys = []
+    for layer in gp.data.layers:
+        for frame in layer.frames:
+            mat, fill, color, points = snapshot_frame(frame, flags)
+            rows, keys = stroke_keys(mat, fill, color, points, flags)
+            if len(rows):
+                frames.append((frame, mat, rows))
+                allKeys.append(keys)
+    if not frames:
+        return 0, 0.0, 0.0
+
+    unique, inverse, weights = np.unique(np.concatenate(allKeys), axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    labels, palette = median_cut(unique, weights, max(1, size))
+
+    # each stroke's error only counts the colors its material shows
+    entries = palette[labels]
+    error = np.sqrt(((unique[:, 2:5] - entries[:, 2:5]) ** 2).sum(axis=1) * unique[:, 0] +
+        ((unique[:, 5:8] - entries[:, 5:8]) ** 2).sum(axis=1) * unique[:, 1])
+
+    index = MaterialIndex(materials)
+    paletteMaterials = np.zeros(len(palette), dtype=np.int32)
+    for i, entry in enumerate(palette):
+        vertex_color = tuple(entry[2:5]) if entry[0] else None
+        vertex_color_fill = tuple(entry[5:8]) if entry[1] else None
+        idx = index.find(vertex_color, vertex_color_fill)
+        if idx is None:
+            gp_mat = new_material(materials, vertex_color, vertex_color_fill, "PALETTE")
+            idx = len(materials) - 1
+            index.add(idx, gp_mat)
+        paletteMaterials[i] = idx
+
+    assigned = paletteMaterials[labels[inverse]]
+    changed = 0
+    start = 0
+    for frame, mat, rows in frames:
+        frameAssigned = assigned[start:start + len(rows)]
+        start += len(rows)
+        frameChanged = frameAssigned != mat[rows]
+        if frameChanged.any():
+            mat[rows] = frameAssigned
+            frame.strokes.foreach_set('material_index', mat)
+            changed += int(frameChanged.sum())
+
+    return changed, float(np.average(error, weights=weights)), float(error.max())
+
+
+if __name__ == "__main__":
+    gp = bpy.context.active_object
+    if gp == None or gp.type != 'GPENCIL':
+        print("Select a grease pencil object")
+    else:
+        if not hasattr(bpy.types, "QUICKTOOLS_OT_create_materials"):
+            bpy.utils.register_class(quickCreateMaterialsOperator)
+        bpy.ops.quicktools.create_materials('INVOKE_DEFAULT')